@@ -0,0 +1,56 @@
+'''
+Import time of `paperdash`, measured in fresh interpreters
+Fails (exit code 1) if the median is above the budget, or if a heavy dependency is imported eagerly
+
+    python benchmarks/bench_import.py --budget 0.25 --output import.json
+'''
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+HEAVY_MODULES = ['pandas', 'matplotlib', 'numpy', 'plotly', 'azure', 'requests', 'pytz']
+
+PROBE = '''
+import json, sys, time
+start = time.perf_counter()
+import paperdash, paperdash.utils, paperdash.batch, paperdash.workflow
+elapsed = time.perf_counter() - start
+print(json.dumps({'seconds': elapsed, 'heavy': [m for m in %r if m in sys.modules]}))
+''' % (HEAVY_MODULES,)
+
+
+def measure(repeat:int) -> dict:
+    samples = []
+    heavy = set()
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', PROBE], capture_output=True, text=True, check=True).stdout
+        result = json.loads(output.strip().split('\n')[-1])
+        samples.append(result['seconds'])
+        heavy.update(result['heavy'])
+    return {
+        'benchmark': 'import',
+        'repeat': repeat,
+        'median_seconds': statistics.median(samples),
+        'min_seconds': min(samples),
+        'max_seconds': max(samples),
+        'heavy_modules_imported': sorted(heavy),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--budget', type=float, default=0.25, help='maximum median import time, in seconds')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    result = measure(args.repeat)
+    result['budget_seconds'] = args.budget
+    result['ok'] = result['median_seconds'] <= args.budget and not result['heavy_modules_imported']
+    print(json.dumps(result, indent=4))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=4)
+    sys.exit(0 if result['ok'] else 1)
@@ -0,0 +1,238 @@
+'''
+Benchmarks of the report build pipeline, stage by stage and end to end, on synthetic reports
+Stages that need pandoc/xelatex are skipped when those are not installed
+
+    python benchmarks/bench_pipeline.py --output pipeline.json
+    python benchmarks/bench_pipeline.py --quick --stages graphs tables
+'''
+import argparse
+import importlib.util
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+
+import paperdash
+from paperdash import blocks, template
+from paperdash.cache import FileCache
+
+SIZES = {
+    'full': {'texts': [100, 10000], 'graphs': [10, 100, 1000], 'rows': [10, 1000, 100000, 1000000]},
+    'quick': {'texts': [100], 'graphs': [10], 'rows': [10, 10000]},
+}
+VARIABLES = {
+    'company': 'Company',
+    'title': 'Customer - From 2020-01-01 to 2020-01-31',
+    'author': 'Author',
+    'subject': 'Benchmark',
+    'keywords': 'benchmark',
+    'date': '2020-01-31 00:00:00',
+}
+
+
+def measure(function:Callable[[], None], repeat:int) -> dict:
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - start)
+    return {'median_seconds': statistics.median(samples), 'min_seconds': min(samples), 'repeat': repeat}
+
+
+def synthetic_table(rows:int) -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    return pd.DataFrame({
+        'id': np.arange(rows),
+        'value': rng.random(rows),
+        'name': [f'item {i}' for i in range(rows)],
+    })
+
+
+def draw_figure(i:int) -> None:
+    plt.figure()
+    plt.plot(np.arange(50), np.sin(np.arange(50) / 5 + i))
+
+
+def new_report(build_root:str, **kwargs) -> paperdash.StaticReport:
+    return paperdash.StaticReport(variables=VARIABLES, build_root=build_root, **kwargs)
+
+
+def bench_texts(build_root:str, sizes:dict, repeat:int) -> List[dict]:
+    results = []
+    for n in sizes['texts']:
+        def run():
+            with new_report(build_root) as report:
+                for i in range(n):
+                    report.add_text(f'Paragraph {i} ' * 10)
+                report.report
+        results.append({'stage': 'add_text', 'size': n, **measure(run, repeat)})
+    return results
+
+
+def bench_graphs(build_root:str, sizes:dict, repeat:int) -> List[dict]:
+    results = []
+    for n in sizes['graphs']:
+        for workers in [0, os.cpu_count() or 1]:
+            def run():
+                with new_report(build_root, figure_workers=workers) as report:
+                    for i in range(n):
+                        draw_figure(i)
+                        report.add_graph()
+                        plt.close()
+                    report.wait_figures()
+            results.append({'stage': 'add_graph', 'size': n, 'figure_workers': workers, **measure(run, repeat)})
+    return results
+
+
+def bench_plotly(build_root:str, sizes:dict, repeat:int) -> List[dict]:
+    '''
+    add_graph with plotly figures (rendered by Kaleido), without and with a warm `figure_cache`
+    '''
+    if importlib.util.find_spec('kaleido') is None:
+        return [{'stage': 'add_graph_plotly', 'skipped': 'kaleido not installed'}]
+    import plotly.graph_objects as go
+    results = []
+    for n in sizes['graphs'][:2]:
+        figures = [go.Figure(go.Scatter(x=np.arange(50), y=np.sin(np.arange(50) / 5 + i))) for i in range(n)]
+        figure_cache = FileCache(os.path.join(build_root, f'plotly_cache_{n}'))
+        for cache in [None, figure_cache]:
+            def run():
+                with new_report(build_root, figure_cache=cache) as report:
+                    for figure in figures:
+                        report.add_graph(plotly_figure=figure)
+                    report.wait_figures()
+            if cache is not None:
+                run()
+            results.append({'stage': 'add_graph_plotly', 'size': n, 'cached': cache is not None, **measure(run, repeat)})
+    return results
+
+
+def bench_tables(build_root:str, sizes:dict, repeat:int) -> List[dict]:
+    results = []
+    for rows in sizes['rows']:
+        df = synthetic_table(rows)
+        for latex in [False, True]:
+            def run():
+                with new_report(build_root) as report:
+                    report.add_table(df, latex=latex)
+                    with open(f'{report.path}/report.md', 'w') as f:
+                        blocks.write_markdown(report.blocks, f)
+            results.append({'stage': 'add_table', 'size': rows, 'latex': latex, **measure(run, repeat)})
+    return results
+
+
+def bench_theme(build_root:str, sizes:dict, repeat:int) -> List[dict]:
+    with new_report(build_root) as report:
+        def run():
+            template.compile_theme(paperdash.theme, report.theme_cache).materialize(report.path, report.variables)
+        return [{'stage': 'theme', 'size': 1, **measure(run, repeat * 10)}]
+
+
+def bench_save(build_root:str, sizes:dict, repeat:int) -> List[dict]:
+    '''
+    save() without compiling (theme, config and markdown), packaging the workspace to zip, and HTML
+    '''
+    results = []
+    with new_report(build_root) as report:
+        for i in range(10):
+            report.add_text(f'Section {i}', style='title1')
+            draw_figure(i)
+            report.add_graph()
+            plt.close()
+            report.add_table(synthetic_table(100))
+        results.append({'stage': 'save_markdown', 'size': 10, **measure(lambda: report.save('bench.pdf', generate_pdf=False), repeat)})
+        # The workspace is already written by the save above, only the packaging is measured
+        results.append({'stage': 'zip', 'size': 10, **measure(lambda: report.package(io.BytesIO()), repeat)})
+        results.append({'stage': 'html', 'size': 10, **measure(lambda: report.save(os.path.join(build_root, 'bench.html')), repeat)})
+    return results
+
+
+def bench_compile(build_root:str, sizes:dict, repeat:int) -> List[dict]:
+    if not shutil.which('pandoc') or not shutil.which('xelatex'):
+        return [{'stage': 'compile', 'skipped': 'pandoc or xelatex not installed'}]
+    results = []
+    for n in sizes['graphs'][:2]:
+        with new_report(build_root) as report:
+            for i in range(n):
+                report.add_text(f'Section {i}', style='title1')
+                draw_figure(i)
+                report.add_graph()
+                plt.close()
+            out_path = os.path.join(build_root, 'bench.pdf')
+            results.append({'stage': 'compile', 'size': n, **measure(lambda: report.save(out_path), repeat)})
+    return results
+
+
+def bench_end_to_end(build_root:str, sizes:dict, repeat:int) -> List[dict]:
+    compile_pdf = bool(shutil.which('pandoc') and shutil.which('xelatex'))
+    results = []
+    for n in sizes['graphs'][:2]:
+        df = synthetic_table(sizes['rows'][-1])
+        def run():
+            with new_report(build_root) as report:
+                for i in range(n):
+                    report.add_text(f'Section {i}', style='title1')
+                    report.add_text('Lorem ipsum ' * 50)
+                    draw_figure(i)
+                    report.add_graph()
+                    plt.close()
+                report.add_table(df, max_rows=1000)
+                report.save(os.path.join(build_root, 'bench.pdf'), generate_pdf=compile_pdf)
+        results.append({'stage': 'end_to_end', 'size': n, 'compile': compile_pdf, **measure(run, repeat)})
+    return results
+
+
+STAGES : Dict[str, Callable[[str, dict, int], List[dict]]] = {
+    'texts': bench_texts,
+    'graphs': bench_graphs,
+    'plotly': bench_plotly,
+    'tables': bench_tables,
+    'theme': bench_theme,
+    'save': bench_save,
+    'compile': bench_compile,
+    'end_to_end': bench_end_to_end,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--stages', nargs='+', choices=list(STAGES), default=list(STAGES))
+    parser.add_argument('--quick', action='store_true', help='only the small sizes')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args()
+
+    sizes = SIZES['quick' if args.quick else 'full']
+    build_root = tempfile.mkdtemp(prefix='paperdash_bench_')
+    results = []
+    try:
+        for stage in args.stages:
+            for result in STAGES[stage](build_root, sizes, args.repeat):
+                print(json.dumps(result), file=sys.stderr)
+                results.append(result)
+    finally:
+        shutil.rmtree(build_root)
+
+    output = {
+        'paperdash_version': paperdash.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'results': results,
+    }
+    print(json.dumps(output, indent=4))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=4)
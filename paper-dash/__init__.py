@@ -1,106 +1,493 @@
 from __future__ import annotations
-import pandas as pd
 import os
-import matplotlib.pyplot as plt
-from plotly.graph_objs._figure import Figure
+import shutil
+import tempfile
+import weakref
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import nullcontext
+from functools import partial
 from uuid import uuid4
-import base64
-from typing import Optional
+import hashlib
+import io
+from typing import BinaryIO, Callable, List, Optional, Tuple, TYPE_CHECKING
 import json
+import re
+import zipfile
+from paperdash.cache import FileCache, content_hash, file_hash, link_or_copy
+from paperdash import runner
+from paperdash import preamble
+from paperdash import html_engine
+from paperdash import blocks
+from paperdash import template
+from paperdash import preprocess
+from paperdash.runner import CommandError
+from paperdash.instrumentation import ReportStats, StageStats
 from shared.reporting.themes import theme_csc as theme
 
+# pandas, matplotlib and plotly are slow to import; they are only imported by the code that uses them
+if TYPE_CHECKING:
+    import numpy as np
+    import pandas as pd
+    import matplotlib.figure
+    from plotly.graph_objs._figure import Figure
+
 __version__ = '0.1.6'
 
+# Passed to plotly when rasterizing; part of the figure cache key
+PLOTLY_IMAGE_OPTIONS = {'format': 'png'}
+
+# Already compressed, deflating them again only costs CPU
+STORED_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.pdf', '.zip', '.gz', '.fmt')
+
+MARKDOWN_IMAGE_PATTERN = re.compile(r'!\[[^\]]*\]\(([^)\s]+)\)')
+
+def memory_build_root() -> str:
+    '''
+    Build root on a memory-backed filesystem (/dev/shm) when available, otherwise in the system temp folder
+    Use with `StaticReport(build_root=memory_build_root())` to compile without touching the disk
+    '''
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm/paperdash'
+    return os.path.join(tempfile.gettempdir(), 'paperdash')
+
+def _render_plotly(spec:str) -> bytes:
+    import plotly.io
+    return plotly.io.from_json(spec).to_image(**PLOTLY_IMAGE_OPTIONS)
+
+def _draw_pixels(figure:matplotlib.figure.Figure) -> Tuple[np.ndarray, float]:
+    '''
+    Draw the figure the way `savefig` would, with the `savefig.dpi`, `savefig.facecolor`, `savefig.edgecolor`
+    and `savefig.transparent` rcParams, and return a copy of its pixels and the dpi
+    '''
+    import matplotlib
+    import numpy as np
+    rc = matplotlib.rcParams
+    dpi = figure.dpi if rc['savefig.dpi'] == 'figure' else rc['savefig.dpi']
+    facecolor = figure.get_facecolor() if rc['savefig.facecolor'] == 'auto' else rc['savefig.facecolor']
+    edgecolor = figure.get_edgecolor() if rc['savefig.edgecolor'] == 'auto' else rc['savefig.edgecolor']
+    patches = [figure.patch]
+    if rc['savefig.transparent']:
+        facecolor = edgecolor = 'none'
+        patches += [ax.patch for ax in figure.axes]
+    # Restored after drawing, the figure is left as it was
+    original = [(patch, patch.get_facecolor(), patch.get_edgecolor()) for patch in patches]
+    original_dpi = figure.dpi
+    try:
+        for patch in patches:
+            patch.set_facecolor(facecolor if patch is figure.patch else 'none')
+            patch.set_edgecolor(edgecolor if patch is figure.patch else 'none')
+        figure.dpi = dpi
+        figure.canvas.draw()
+        pixels = np.asarray(figure.canvas.buffer_rgba()).copy()
+    finally:
+        figure.dpi = original_dpi
+        for patch, face, edge in original:
+            patch.set_facecolor(face)
+            patch.set_edgecolor(edge)
+    return pixels, dpi
+
+def _encode_png(pixels:np.ndarray, dpi:float) -> bytes:
+    # Same call used by matplotlib's Agg backend in `savefig`
+    import matplotlib.image
+    buffer = io.BytesIO()
+    matplotlib.image.imsave(buffer, pixels, format='png', origin='upper', dpi=dpi)
+    return buffer.getvalue()
+
 class StaticReport():
-    def __init__(self, variables:dict={}, engine:str='default', verbosity:int=0):
+    def __init__(
+        self,
+        variables:dict={},
+        engine:str='default',
+        verbosity:int=0,
+        build_root:str='.report_temp',
+        path:Optional[str]=None,
+        figure_cache:Optional[FileCache]=None,
+        figure_workers:int=0,
+        pdf_cache:Optional[FileCache]=None,
+        format_cache:Optional[FileCache]=None,
+        theme_cache:Optional[str]=None,
+        strict_variables:bool=False,
+        stats:Optional[ReportStats]=None,
+        preprocessors:List[preprocess.Filter]=[],
+    ):
+        '''
+        Each report is built inside its own workspace, a unique folder under `build_root`,
+        so several reports can be rendered at the same time without overwriting each other
+        If `path` is given it is used as the workspace instead, and it is not removed by `cleanup`
+        Call `cleanup` (or use the report as a context manager) to remove the workspace; otherwise it is removed
+        when the report is garbage collected, or at exit
+        `figure_cache` keeps the rasterized graphs between reports and runs, so identical figures are rendered only once
+        With `figure_workers` > 0, `add_graph` only takes a snapshot of the figure and the PNG is produced
+        by a background thread pool; `save` waits for all of them before compiling
+        `pdf_cache` keeps the compiled PDFs by a fingerprint of all the compilation inputs,
+        so saving again a report that did not change does not run pandoc
+        With `format_cache`, the static part of the LaTeX preamble is precompiled once into a format file
+        and reused by later compiles (see `paperdash.preamble`)
+        `theme_cache` is the folder where the theme files that do not depend on variables are written once,
+        to be hardlinked into each workspace (default: `build_root/themes`)
+        With `strict_variables`, `save` raises `ValueError` if a variable required by the theme is missing
+        `stats` records the time, CPU and bytes written by each `add_*` call and each phase of `save`
+        `preprocessors` are line filters applied to `report.md` before compiling (see `paperdash.preprocess`)
+        '''
         self.variables = variables
         self.verbosity = verbosity
         self.engine = engine
-        self.report = ''
+        self.figure_cache = figure_cache
+        self.figure_workers = figure_workers
+        self.pdf_cache = pdf_cache
+        self.format_cache = format_cache
+        # Absolute, so it does not move with the working directory (it should stay on the workspace filesystem for hardlinks)
+        self.theme_cache = os.path.abspath(theme_cache or os.path.join(build_root, 'themes'))
+        self.strict_variables = strict_variables
+        self.stats = stats
+        self.preprocessors = list(preprocessors)
+        self.blocks : List[blocks.Block] = []
+        self._figures : set = set()
+        self._pending_figures : List[Future] = []
+        self._figure_executor : Optional[ThreadPoolExecutor] = None
+
+        if path:
+            os.makedirs(path, exist_ok=True)
+            self.path = os.path.abspath(path)
+            self.owns_path = False
+            self._finalizer = None
+        else:
+            os.makedirs(build_root, exist_ok=True)
+            self.path = os.path.abspath(tempfile.mkdtemp(prefix='report_', dir=build_root))
+            self.owns_path = True
+            # Removes the workspace when the report is garbage collected (or at exit) if `cleanup` was not called
+            self._finalizer = weakref.finalize(self, shutil.rmtree, self.path, True)
+
+    def __enter__(self) -> StaticReport:
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.cleanup()
+
+    def __getstate__(self) -> dict:
+        # Pending figures are finished before the report is sent to another process
+        self.wait_figures()
+        state = self.__dict__.copy()
+        state['_pending_figures'] = []
+        state['_figure_executor'] = None
+        # Copies (eg: in a `render_many` worker) must not remove the workspace when they are collected
+        state['_finalizer'] = None
+        return state
+
+    def cleanup(self) -> None:
+        '''
+        Remove the workspace, if it was created by this report
+        '''
+        if self._figure_executor:
+            self._figure_executor.shutdown(wait=True, cancel_futures=True)
+            self._figure_executor = None
+            self._pending_figures = []
+        if self._finalizer:
+            self._finalizer()
+        elif self.owns_path and os.path.exists(self.path):
+            shutil.rmtree(self.path)
 
-        #if os.path.exists(f".report_temp/"):
-        #    os.system(f"rm -r .report_temp/")
-        if not os.path.exists(f".report_temp/"):
-            os.system(f"mkdir .report_temp/")
-        
     @classmethod
-    def load(cls, path : str) -> StaticReport:
+    def load(cls, path : str, **kwargs) -> StaticReport:
+        '''
+        Reopen a report from a folder previously generated by `save`; the folder is used as workspace
+        kwargs are passed to the constructor (eg: `preprocessors`)
+        '''
         with open(f'{path}/config.json', 'r') as f:
             config = json.loads(f.read())
         report = StaticReport(
             variables = config['variables'], 
             engine = config['engine'], 
             verbosity = config['verbosity'],
+            path = path,
+            **kwargs
         )
         return report 
     
+    def _stage(self, name:str, **labels:str):
+        if self.stats:
+            return self.stats.stage(name, **labels)
+        return nullcontext(StageStats(name))
+
+    @property
+    def report(self) -> str:
+        '''
+        Markdown of the whole report, generated from the blocks
+        '''
+        return blocks.to_markdown(self.blocks)
+
     def add_text(self, text:str, style:str = 'normal'):
-        if style=='title1': text = '# ' + text
-        elif style=='title2': text = '## ' + text
-        elif style=='normal': text = text + '\n'
+        if style=='title1': block = blocks.Heading(text, 1)
+        elif style=='title2': block = blocks.Heading(text, 2)
+        elif style=='normal': block = blocks.Text(text)
         else:
             raise NotImplementedError('Unsupported style')
 
         #if self.verbosity: display(Markdown(text))
-        self.report += text + '\n'
+        with self._stage('add_text'):
+            self.blocks.append(block)
     
     def add_graph(self, width:str='100%', plotly_figure: Optional[Figure] = None):
+        '''
+        Images are named by content, so the same graph is stored only once in the workspace
+        Plotly figures are keyed by their JSON and render options, and are not rendered again on a cache hit
+        Matplotlib figures are saved with `plt.savefig`, so all the `savefig.*` rcParams apply; with `figure_workers`,
+        they are keyed by the drawn pixels and encoded in background, which honours `savefig.dpi`, `savefig.facecolor`,
+        `savefig.edgecolor` and `savefig.transparent` (with `savefig.bbox='tight'` they are saved right away)
+        '''
         # Other styling options: https://stackoverflow.com/a/34894696/12555523
-        id = str(uuid4())
-        if plotly_figure:
-            plotly_figure.write_image(f".report_temp/{id}.png")
-        else:
-            plt.savefig(f".report_temp/{id}.png")
-        self.report += '\n\n' + f'![]({id}.png)' + '{width=' + width + '}' + '\\ \n\n'
+        with self._stage('add_graph', kind='plotly' if plotly_figure else 'matplotlib'):
+            id, render = self._snapshot_figure(plotly_figure)
+            if id not in self._figures:
+                self._figures.add(id)
+                if self.figure_workers > 0:
+                    if not self._figure_executor:
+                        self._figure_executor = ThreadPoolExecutor(max_workers=self.figure_workers)
+                    self._pending_figures.append(self._figure_executor.submit(self._store_figure, id, render))
+                else:
+                    self._store_figure(id, render)
+            self.blocks.append(blocks.Image(f'{id}.png', width))
     
-    def add_table(self, df:pd.DataFrame, index:bool=False):
-        text = df.to_markdown(index=index)
+    def _snapshot_figure(self, plotly_figure: Optional[Figure] = None) -> Tuple[str, Callable[[], bytes]]:
+        '''
+        Capture the figure as it is now, returning its content key and a function that produces the PNG
+        The returned function does not touch the figure, so it can run in another thread
+        '''
+        if plotly_figure:
+            spec = plotly_figure.to_json()
+            id = content_hash(spec, json.dumps(PLOTLY_IMAGE_OPTIONS, sort_keys=True))
+            return id, partial(_render_plotly, spec)
+        import matplotlib
+        import matplotlib.pyplot as plt
+        figure = plt.gcf()
+        if self.figure_workers > 0 and hasattr(figure.canvas, 'buffer_rgba') and matplotlib.rcParams['savefig.bbox'] != 'tight':
+            pixels, dpi = _draw_pixels(figure)
+            id = content_hash(pixels.tobytes(), str(pixels.shape), str(dpi))
+            return id, partial(_encode_png, pixels, dpi)
+        # Synchronous, or a backend without a pixel buffer: rasterize right away
+        buffer = io.BytesIO()
+        plt.savefig(buffer, format='png')
+        content = buffer.getvalue()
+        return content_hash(content), lambda: content
+
+    def _store_figure(self, id:str, render:Callable[[], bytes]) -> None:
+        with self._stage('rasterize') as record:
+            image_path = f"{self.path}/{id}.png"
+            if os.path.exists(image_path):
+                return
+            cached_path = self.figure_cache.get(id) if self.figure_cache else None
+            if cached_path:
+                try:
+                    link_or_copy(cached_path, image_path)
+                    return
+                except FileNotFoundError:
+                    # Evicted in the meantime by another worker or process
+                    pass
+            content = render()
+            record.bytes_written = len(content)
+            # Written to the workspace first, and cached from there
+            with open(image_path, 'wb') as f:
+                f.write(content)
+            if self.figure_cache:
+                self.figure_cache.put_file(id, image_path)
+
+    def wait_figures(self) -> None:
+        '''
+        Block until all the graphs added in background are written to the workspace
+        Errors raised while rasterizing are raised here
+        '''
+        pending, self._pending_figures = self._pending_figures, []
+        for future in pending:
+            future.result()
+
+    def add_table(
+        self,
+        df:pd.DataFrame,
+        index:bool=False,
+        columns:Optional[List[str]]=None,
+        max_rows:Optional[int]=None,
+        latex:bool=False,
+        chunk_size:int=10000,
+    ):
+        '''
+        The table is written to the markdown file `chunk_size` rows at a time, when the report is saved
+        :param columns show only these columns
+        :param max_rows show only the first rows, followed by a "N more rows" note
+        :param latex write a LaTeX `longtable` directly, instead of a markdown table for pandoc to parse
+        '''
         #if self.verbosity: display(Markdown(text))
-        self.report += '\n\n' + text + '\n\n'
+        with self._stage('add_table'):
+            self.blocks.append(blocks.Table(df, index, columns, max_rows, latex, chunk_size))
 
-    def generate_pdf(
+    def _pandoc_argv(
         self,
-        filename : str, 
         toc : bool = False, 
         cover : bool = False, 
         header_footer : bool=True, 
         header_footer_fist : bool=False, 
         chapter_break : bool=False, 
-    ):
-        if os.path.exists(f'.report_temp/{filename}'):
-            os.system(f'''rm .report_temp/{filename}''')
-        command = f'''
-        cd .report_temp/ && \
-        pandoc \
-        report.md \
-        --from markdown+pipe_tables+link_attributes+yaml_metadata_block \
-        --pdf-engine=xelatex \
-        --highlight-style pygments.theme \
-        --include-in-header basic_headers.tex \
-        -V linkcolor:blue \
-        -V mainfont="DejaVu Sans" \
-        -V monofont="DejaVu Sans Mono" '''
+    ) -> List[str]:
+        argv = [
+            'pandoc',
+            'report.md',
+            '--from', 'markdown+pipe_tables+link_attributes+yaml_metadata_block',
+            '--pdf-engine=xelatex',
+            '--highlight-style', 'pygments.theme',
+            '--include-in-header', 'basic_headers.tex',
+            '-V', 'linkcolor:blue',
+            '-V', 'mainfont=DejaVu Sans',
+            '-V', 'monofont=DejaVu Sans Mono',
+            # loads longtable/booktabs even if all tables are raw LaTeX (see `add_table`)
+            '-V', 'tables=true',
+        ]
         for header_name in theme['tex_headers']:
-            command += f' --include-in-header {header_name} '
+            argv += ['--include-in-header', header_name]
         if header_footer:
-            command += '--include-in-header header_footer.tex '
+            argv += ['--include-in-header', 'header_footer.tex']
         if header_footer_fist==False:
-            command += '--include-before-body header_footer_no_first.tex '
+            argv += ['--include-before-body', 'header_footer_no_first.tex']
         if chapter_break:
-            command += '--include-in-header chapter_break.tex '
+            argv += ['--include-in-header', 'chapter_break.tex']
         if toc:
-            command += '''
-                --toc \
-                -V toc-title='Table of contents' \
-            '''
+            argv += ['--toc', '-V', 'toc-title=Table of contents']
         if cover:
             # requires image
             # may interfere with header_footer_fist
-            command += '--include-before-body cover.tex '
+            argv += ['--include-before-body', 'cover.tex']
             raise NotImplementedError() 
-        command += f'-o ../{filename}'
-        print(command)
-        os.system(command)
+        return argv
+
+    def fingerprint(self, argv : List[str]) -> str:
+        '''
+        Hash of everything that can change the PDF: pandoc options, variables,
+        the markdown, the theme files and the images it references
+        The files are read in chunks, and the markdown is scanned line by line, so memory does not grow with the report
+        '''
+        markdown = hashlib.sha256()
+        images = []
+        with open(f'{self.path}/report.md', 'rb') as f:
+            for line in f:
+                markdown.update(line)
+                if b'](' in line:
+                    images += MARKDOWN_IMAGE_PATTERN.findall(line.decode('utf-8', errors='replace'))
+        names = [argv[i+1] for i in range(len(argv)-1) if argv[i] in ('--include-in-header', '--include-before-body', '--highlight-style')]
+        names += list(theme['images'])
+        names += images
+        parts = [json.dumps(argv), json.dumps(self.variables, sort_keys=True), markdown.hexdigest()]
+        for name in dict.fromkeys(names):
+            parts.append(name)
+            try:
+                parts.append(file_hash(f'{self.path}/{name}'))
+            except FileNotFoundError:
+                parts.append('')
+        return content_hash(*parts)
+
+    def generate_pdf(
+        self,
+        filename : str, 
+        toc : bool = False, 
+        cover : bool = False, 
+        header_footer : bool=True, 
+        header_footer_fist : bool=False, 
+        chapter_break : bool=False, 
+        timeout : Optional[float] = 600,
+    ):
+        '''
+        Run pandoc inside the workspace; if it fails or takes more than `timeout` seconds, raise `CommandError`
+        With a `pdf_cache`, pandoc is skipped when the same inputs were already compiled
+        '''
+        out_path = os.path.abspath(filename)
+        if os.path.exists(out_path):
+            os.remove(out_path)
+        argv = self._pandoc_argv(toc, cover, header_footer, header_footer_fist, chapter_break)
+
+        fingerprint = None
+        if self.pdf_cache:
+            fingerprint = self.fingerprint(argv)
+            cached_path = self.pdf_cache.get(fingerprint)
+            if cached_path:
+                if self.verbosity:
+                    print(f'Inputs did not change, reusing {cached_path}')
+                try:
+                    shutil.copyfile(cached_path, out_path)
+                    return
+                except FileNotFoundError:
+                    # Evicted in the meantime, compile it again
+                    pass
+
+        if self.verbosity:
+            print(' '.join(argv))
+        if self.format_cache:
+            preamble.compile_pdf(self.path, argv, theme['files'], out_path, self.format_cache, toc, timeout)
+        else:
+            runner.run(argv + ['-o', out_path], cwd=self.path, timeout=timeout)
+        if fingerprint:
+            self.pdf_cache.put_file(fingerprint, out_path)
+
+    def package(self, fileobj : Optional[BinaryIO] = None) -> Optional[bytes]:
+        '''
+        Zip the workspace in a single pass, straight into `fileobj` (any writable binary file, eg: an open file or a buffer)
+        Without `fileobj`, the zip is returned as bytes
+        Images and other compressed files are stored, everything else is deflated
+        '''
+        buffer = None
+        if fileobj is None:
+            buffer = fileobj = io.BytesIO()
+        with zipfile.ZipFile(fileobj, 'w') as z:
+            for root, dirs, files in os.walk(self.path):
+                dirs.sort()
+                for name in sorted(files):
+                    path = os.path.join(root, name)
+                    info = zipfile.ZipInfo.from_file(path, os.path.relpath(path, self.path))
+                    # Readable and writable by whoever unzips it
+                    info.external_attr = (0o100777 << 16)
+                    if name.lower().endswith(STORED_EXTENSIONS):
+                        info.compress_type = zipfile.ZIP_STORED
+                    else:
+                        info.compress_type = zipfile.ZIP_DEFLATED
+                    with open(path, 'rb') as src, z.open(info, 'w') as dst:
+                        shutil.copyfileobj(src, dst, 1024 * 1024)
+        return buffer.getvalue() if buffer else None
+
+    def generate_html(self, filename : Optional[str], return_bytes : bool = False, generate_markdown : bool = True) -> Optional[bytes]:
+        '''
+        Render the report in-process to a single HTML file, with the images embedded; pandoc is not needed
+        If `filename` is None nothing is written, and the content is returned
+        With `preprocessors` (or without `generate_markdown`) the page is rendered from `report.md`,
+        after the filters ran on it, like the PDF
+        '''
+        from_blocks = generate_markdown and not self.preprocessors
+        if not from_blocks:
+            self._write_markdown(generate_markdown)
+        with self._stage('html') as record:
+            if from_blocks:
+                content = html_engine.render_blocks(self.blocks, self.path, self.variables, theme)
+            else:
+                with open(f'{self.path}/report.md', 'r', encoding='utf-8') as f:
+                    content = html_engine.render(f.read(), self.path, self.variables, theme)
+            content = content.encode('utf-8')
+            if filename:
+                with open(filename, 'wb') as f:
+                    f.write(content)
+                record.bytes_written = len(content)
+        return content if return_bytes or not filename else None
+
+    def _write_markdown(self, generate_markdown : bool) -> None:
+        '''
+        Write `report.md` from the blocks (or check that it exists) and run the `preprocessors` on it
+        '''
+        if generate_markdown:
+            with self._stage('markdown') as record:
+                with open(f'{self.path}/report.md', 'w', encoding='utf-8', newline='') as f:
+                    blocks.write_markdown(self.blocks, f)
+                    record.bytes_written = f.tell()
+        elif not os.path.exists(f'{self.path}/report.md'):
+            raise ValueError('Markdown file should already exist if you do not want to generate it')
+
+        if self.preprocessors:
+            with self._stage('preprocess') as record:
+                preprocess.process_file(f'{self.path}/report.md', f'{self.path}/report.md', self.preprocessors)
+                record.bytes_written = os.path.getsize(f'{self.path}/report.md')
 
     def save(
             self, 
@@ -115,70 +502,95 @@ class StaticReport():
             clean_temp_folder : bool = False,
             zip_temp_folder : Optional[str] = None,
             generate_pdf : bool = True,
+            timeout : Optional[float] = 600,
+            stream : Optional[BinaryIO] = None,
         ) -> Optional[bytes]:
+        '''
+        Without `filename`, the output is compiled to a temporary file next to the workspace (so it is not packaged
+        with it), returned as bytes (or written to `stream`) and removed; combined with a memory-backed `build_root` (see `memory_build_root`) and the report used
+        as a context manager, nothing is left on disk
+        If `stream` is given, the output is copied to it instead of being returned
+        '''
         # TODO: maybe this function should be refactored to something like "compile()"
-        #TODO: filename can't contain spaces
         #TODO: refactor to use only python dependencies
         #TODO: chose a better font
-        #TODO: do a `cd` into report_temp, so we can open the markdown and see the images
         #TODO: separe the style logic from the export logic
-        if not os.path.exists(f".report_temp/"):
-            os.system(f"mkdir .report_temp/")
+        os.makedirs(self.path, exist_ok=True)
+        with self._stage('wait_figures'):
+            self.wait_figures()
 
-        if not filename:
-            filename = str(uuid4()) + '.pdf'
-            return_bytes = True
+        temporary_output = not filename
+        if temporary_output:
+            filename = os.path.join(
+                os.path.dirname(self.path),
+                f'.{os.path.basename(self.path)}_{uuid4()}' + ('.html' if self.engine == 'html' else '.pdf'),
+            )
+            # Return whatever is generated: the output, or the zip
+            return_bytes = stream is None and (generate_pdf or self.engine == 'html' or bool(zip_temp_folder))
+        if self.engine == 'html' or filename[-4:] == 'html':
+            if filename[-4:] != 'html':
+                raise NotImplementedError('The html engine only generates .html files')
+            content = self.generate_html(None if temporary_output else filename, True, generate_markdown)
+            if clean_temp_folder:
+                self.cleanup()
+            if stream:
+                stream.write(content)
+                return None
+            return content if return_bytes else None
         if filename[-3:] != 'pdf':
             raise NotImplementedError('Unsuported format')
 
         # Prepare files to be converted
-        for style_filename in theme['files']:
-            with open(f'.report_temp/{style_filename}', 'w') as f:
-                text = theme['files'][style_filename]
-                for v in self.variables:
-                    text = text.replace('$' + v + '$', self.variables[v])
-                f.write(text)
-        for image_filename in theme['images']:
-            # TODO:
-            # this was a quick and dirty solution to include images in the header
-            # Maybe a better solution is to have the images stored in azure storage, 
-            # or receive the images in the report creation
-            with open(f'.report_temp/{image_filename}', 'wb') as f:
-                f.write(base64.b64decode(theme['images'][image_filename]))
-
-        with open('./.report_temp/config.json', 'w') as f:
+        # TODO:
+        # the theme images were a quick and dirty solution to include images in the header
+        # Maybe a better solution is to have the images stored in azure storage, 
+        # or receive the images in the report creation
+        with self._stage('theme') as record:
+            record.bytes_written = template.compile_theme(theme, self.theme_cache).materialize(self.path, self.variables, self.strict_variables)
+
+        with open(f'{self.path}/config.json', 'w') as f:
             f.write(json.dumps({
                 'engine': self.engine,
                 'variables': self.variables,
                 'verbosity': self.verbosity,
             }))
 
-        if generate_markdown:
-            with open('.report_temp/report.md', 'wb') as f:
-                f.write(self.report.encode('utf-8'))
-        elif not os.path.exists('.report_temp/report.md'):
-            raise ValueError('Markdown file should already exist if you do not want to generate it')
+        self._write_markdown(generate_markdown)
 
         if generate_pdf:
-            self.generate_pdf(filename, toc, cover, header_footer, header_footer_fist, chapter_break)
+            with self._stage('compile') as record:
+                self.generate_pdf(filename, toc, cover, header_footer, header_footer_fist, chapter_break, timeout)
+                record.bytes_written = os.path.getsize(filename)
 
+        zip_content = None
         if zip_temp_folder:
-            os.system(f'chmod 777 -R .report_temp/')
-            os.system(f'cp -r .report_temp {zip_temp_folder}')
-            os.system(f'cd {zip_temp_folder} && zip -r {zip_temp_folder}.zip . && cd .. && cp {zip_temp_folder}/{zip_temp_folder}.zip {zip_temp_folder}.zip')
-
-        if return_bytes and generate_pdf:
-            with open(f'.report_temp/{filename}', 'rb') as f:
-                response = f.read()
-        elif return_bytes and zip_temp_folder:
-            with open(f'{zip_temp_folder}.zip', 'rb') as f:
-                response = f.read()
-        elif return_bytes:
-            raise ValueError('Nothing to return')
-        else:
+            with self._stage('zip') as record:
+                if return_bytes and not generate_pdf:
+                    # Will be returned; keep it in memory instead of reading it back
+                    zip_content = self.package()
+                    with open(f'{zip_temp_folder}.zip', 'wb') as f:
+                        f.write(zip_content)
+                else:
+                    with open(f'{zip_temp_folder}.zip', 'wb') as f:
+                        self.package(f)
+                record.bytes_written = os.path.getsize(f'{zip_temp_folder}.zip')
+
+        with self._stage('read'):
             response = None
+            if stream and generate_pdf:
+                with open(os.path.abspath(filename), 'rb') as f:
+                    shutil.copyfileobj(f, stream)
+            elif return_bytes and generate_pdf:
+                with open(os.path.abspath(filename), 'rb') as f:
+                    response = f.read()
+            elif return_bytes and zip_temp_folder:
+                response = zip_content
+            elif return_bytes:
+                raise ValueError('Nothing to return')
+        if temporary_output and os.path.exists(filename):
+            os.remove(filename)
 
         if clean_temp_folder:
-            os.system(f"rm -r .report_temp/")
+            self.cleanup()
 
         return response
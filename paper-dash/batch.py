@@ -0,0 +1,78 @@
+from __future__ import annotations
+import os
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional, Tuple
+from paperdash import StaticReport
+from paperdash.instrumentation import StageStats
+
+
+@dataclass
+class RenderResult:
+    index : int
+    filename : Optional[str]
+    content : Optional[bytes] = None
+    error : Optional[BaseException] = None
+    # Stages of `save` measured in the worker, when the report has `stats`
+    stats : List[StageStats] = field(default_factory=list)
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def _render(report : StaticReport, filename : Optional[str], save_kwargs : dict) -> Tuple[Optional[bytes], List[StageStats]]:
+    # The report is a copy in the worker, its records are sent back with the result
+    start = len(report.stats.records) if report.stats else 0
+    content = report.save(filename, **save_kwargs)
+    return content, report.stats.records[start:] if report.stats else []
+
+
+def render_many(
+    reports : List[StaticReport],
+    filenames : Optional[List[Optional[str]]] = None,
+    max_workers : Optional[int] = None,
+    progress : Optional[Callable[[int, int, RenderResult], None]] = None,
+    **save_kwargs,
+) -> List[RenderResult]:
+    '''
+    Call `save` for all the reports in a process pool, one pandoc/xelatex run per worker
+    `filenames` has one entry per report; when omitted (or `None` for a report) the PDF bytes are returned
+    `max_workers` defaults to the number of cores, and at most twice that many reports are queued at once
+    `progress(done, total, result)` is called in the parent process after each report finishes
+    Errors do not stop the batch; they are returned in the corresponding `RenderResult`
+    The stages of `save` are measured in the workers, so they are returned in `RenderResult.stats`
+    instead of being added to the reports' `stats`
+    kwargs will be passed to `save`
+    '''
+    if filenames is None:
+        filenames = [None] * len(reports)
+    if len(filenames) != len(reports):
+        raise ValueError('There should be one filename per report')
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+
+    total = len(reports)
+    results : List[Optional[RenderResult]] = [None] * total
+    pending = {}
+    done_count = 0
+    next_index = 0
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        while next_index < total or pending:
+            while next_index < total and len(pending) < 2 * max_workers:
+                future = executor.submit(_render, reports[next_index], filenames[next_index], save_kwargs)
+                pending[future] = next_index
+                next_index += 1
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                index = pending.pop(future)
+                result = RenderResult(index=index, filename=filenames[index])
+                if future.exception() is not None:
+                    result.error = future.exception()
+                else:
+                    result.content, result.stats = future.result()
+                results[index] = result
+                done_count += 1
+                if progress:
+                    progress(done_count, total, result)
+    return results
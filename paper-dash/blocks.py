@@ -0,0 +1,144 @@
+'''
+Content of a `StaticReport`, kept as a list of blocks
+The markdown is only generated when a backend needs it (see `to_markdown`)
+'''
+import io
+from typing import Any, Iterable, Iterator, List, Optional, TextIO
+from paperdash.template import latex_escape
+
+class Block():
+    __slots__ = ()
+
+    def to_markdown(self) -> str:
+        raise NotImplementedError()
+
+    def write(self, f:TextIO) -> None:
+        f.write(self.to_markdown())
+
+
+class Heading(Block):
+    __slots__ = ('text', 'level')
+
+    def __init__(self, text:str, level:int=1):
+        self.text = text
+        self.level = level
+
+    def to_markdown(self) -> str:
+        return '#' * self.level + ' ' + self.text + '\n'
+
+
+class Text(Block):
+    __slots__ = ('text',)
+
+    def __init__(self, text:str):
+        self.text = text
+
+    def to_markdown(self) -> str:
+        return self.text + '\n\n'
+
+
+class Image(Block):
+    '''
+    :param name file name, relative to the report workspace
+    '''
+    __slots__ = ('name', 'width')
+
+    def __init__(self, name:str, width:str='100%'):
+        self.name = name
+        self.width = width
+
+    def to_markdown(self) -> str:
+        return '\n\n' + f'![]({self.name})' + '{width=' + self.width + '}' + '\\ \n\n'
+
+
+class Table(Block):
+    '''
+    Keeps a copy of the shown rows and columns, so later changes to the DataFrame do not affect the report;
+    it is only converted to text when the output is generated, `chunk_size` rows at a time,
+    so a large table is never fully rendered in memory
+    :param columns only these columns are shown
+    :param max_rows only the first rows are shown, followed by a "N more rows" note
+    :param latex emit a raw LaTeX `longtable` instead of a markdown pipe table (PDF output only)
+    '''
+    __slots__ = ('df', 'total_rows', 'index', 'columns', 'max_rows', 'latex', 'chunk_size')
+
+    def __init__(
+        self,
+        df:Any,
+        index:bool=False,
+        columns:Optional[List[str]]=None,
+        max_rows:Optional[int]=None,
+        latex:bool=False,
+        chunk_size:int=10000,
+    ):
+        # A shallow copy shares the data with the caller's DataFrame (before pandas copy-on-write)
+        shown = df if max_rows is None else df.iloc[:max_rows]
+        if columns is not None:
+            shown = shown[columns]
+        self.df = shown.copy(deep=True)
+        self.total_rows = len(df)
+        self.index = index
+        self.columns = columns
+        self.max_rows = max_rows
+        self.latex = latex
+        self.chunk_size = chunk_size
+
+    @property
+    def shown_rows(self) -> int:
+        return len(self.df)
+
+    def chunks(self) -> Iterator[Any]:
+        for start in range(0, max(self.shown_rows, 1), self.chunk_size):
+            yield self.df.iloc[start:start + self.chunk_size]
+
+    def to_markdown(self) -> str:
+        f = io.StringIO()
+        self.write(f)
+        return f.getvalue()
+
+    def write(self, f:TextIO) -> None:
+        f.write('\n\n')
+        if self.latex:
+            self._write_latex(f)
+        else:
+            self._write_pipe(f)
+        hidden = self.total_rows - self.shown_rows
+        if hidden > 0:
+            f.write(f'\n\n*{hidden} more rows*')
+        f.write('\n\n')
+
+    def _write_pipe(self, f:TextIO) -> None:
+        for i, chunk in enumerate(self.chunks()):
+            text = chunk.to_markdown(index=self.index)
+            if i == 0:
+                f.write(text)
+            else:
+                # header and alignment rows were already written
+                f.write('\n' + text.split('\n', 2)[2])
+
+    def _write_latex(self, f:TextIO) -> None:
+        def row(values:Iterable[Any]) -> str:
+            return ' & '.join(latex_escape(str(value)) for value in values) + ' \\\\\n'
+        for i, chunk in enumerate(self.chunks()):
+            if i == 0:
+                header = list(chunk.columns)
+                alignment = ['r' if kind in 'iuf' else 'l' for kind in chunk.dtypes.map(lambda dtype: dtype.kind)]
+                if self.index:
+                    header = [chunk.index.name or ''] + header
+                    alignment = ['l'] + alignment
+                f.write('```{=latex}\n')
+                f.write('\\begin{longtable}[]{@{}' + ''.join(alignment) + '@{}}\n\\toprule\n')
+                f.write(row(header))
+                f.write('\\midrule\n\\endhead\n')
+            for values in chunk.itertuples(index=self.index, name=None):
+                f.write(row(values))
+        f.write('\\bottomrule\n\\end{longtable}\n```')
+
+
+def write_markdown(blocks:Iterable[Block], f:TextIO) -> None:
+    for block in blocks:
+        block.write(f)
+
+
+def to_markdown(blocks:Iterable[Block]) -> str:
+    return ''.join(block.to_markdown() for block in blocks)
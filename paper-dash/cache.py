@@ -0,0 +1,144 @@
+import hashlib
+import os
+import shutil
+import tempfile
+from typing import BinaryIO, Callable, Optional, Union
+
+
+def content_hash(*parts : Union[bytes, str]) -> str:
+    '''
+    sha256 of all the parts, in order
+    '''
+    h = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode('utf-8')
+        h.update(part)
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+def file_hash(path : str, chunk_size : int = 1024 * 1024) -> str:
+    '''
+    sha256 of the file content, read `chunk_size` bytes at a time
+    '''
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def link_or_copy(src : str, dst : str) -> None:
+    '''
+    Hardlink `src` to `dst`, falling back to a copy (eg: across filesystems)
+    Does nothing if `dst` already exists; raises `FileNotFoundError` if `src` does not exist
+    '''
+    if os.path.exists(dst):
+        return
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class FileCache():
+    '''
+    Folder of files named by a content key, shared between reports and runs
+    When the total size goes above `max_bytes` the least recently used files are removed
+    Another process can evict a file at any moment, so a path returned by `get`/`put` may be gone
+    when it is used; callers should handle `FileNotFoundError` as a cache miss
+    '''
+    def __init__(self, path:str, max_bytes:int=1024**3):
+        os.makedirs(path, exist_ok=True)
+        self.path = os.path.abspath(path)
+        self.max_bytes = max_bytes
+        self.size : Optional[int] = None # estimate, corrected on every eviction
+
+    def __getstate__(self) -> dict:
+        return {'path': self.path, 'max_bytes': self.max_bytes}
+
+    def __setstate__(self, state:dict) -> None:
+        self.__init__(state['path'], state['max_bytes'])
+
+    def _path(self, key:str) -> str:
+        return f'{self.path}/{key}'
+
+    def get(self, key:str) -> Optional[str]:
+        '''
+        Path of the cached file, or None if it is not in the cache
+        '''
+        path = self._path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def remove(self, key:str) -> None:
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def put(self, key:str, content:bytes) -> str:
+        '''
+        Store `content` under `key` and return its path
+        The file is written to a temporary name and then renamed, so concurrent readers never see it half written
+        '''
+        return self._store(key, lambda f: f.write(content))
+
+    def put_file(self, key:str, src:str) -> str:
+        '''
+        Same as `put`, copying the content from the file `src`
+        '''
+        def write(f) -> int:
+            with open(src, 'rb') as source:
+                shutil.copyfileobj(source, f)
+            return f.tell()
+        return self._store(key, write)
+
+    def _store(self, key:str, write:Callable[[BinaryIO], int]) -> str:
+        fd, temp_path = tempfile.mkstemp(dir=self.path, prefix='.tmp_')
+        with os.fdopen(fd, 'wb') as f:
+            size = write(f)
+        path = self._path(key)
+        os.replace(temp_path, path)
+        if self.size is None:
+            self.evict(keep=path)
+        else:
+            self.size += size
+            if self.size > self.max_bytes:
+                self.evict(keep=path)
+        return path
+
+    def evict(self, keep:Optional[str]=None) -> int:
+        '''
+        Remove least recently used files until the cache fits in `max_bytes`
+        The file `keep` (the one just stored) is never removed, even if it alone is larger than `max_bytes`
+        Return the number of removed files
+        '''
+        entries = []
+        total = 0
+        for entry in os.scandir(self.path):
+            if entry.name.startswith('.tmp_') or not entry.is_file():
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            total += stat.st_size
+            if entry.path != keep:
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        self.size = total
+        return removed
@@ -0,0 +1,202 @@
+'''
+In-process HTML output: converts the report markdown to a single self-contained HTML file
+Only the markdown generated by `StaticReport` is supported (headings, paragraphs, lists, images, pipe tables)
+'''
+import base64
+import html
+import mimetypes
+import os
+import re
+from typing import List, Optional
+from paperdash import blocks
+
+IMAGE_PATTERN = re.compile(r'^!\[([^\]]*)\]\(([^)\s]+)\)(\{([^}]*)\})?\\?\s*$')
+HEADING_PATTERN = re.compile(r'^(#{1,6})\s+(.*)$')
+LIST_PATTERN = re.compile(r'^\s*([-*+]|\d+\.)\s+(.*)$')
+LINK_PATTERN = re.compile(r'\[([^\]]+)\]\(([^)\s]+)\)')
+INLINE_PATTERNS = [
+    (re.compile(r'`([^`]+)`'), r'<code>\1</code>'),
+    (re.compile(r'\*\*(.+?)\*\*'), r'<strong>\1</strong>'),
+    (re.compile(r'\*(.+?)\*'), r'<em>\1</em>'),
+]
+# Links with these schemes run code when clicked; they are rendered as plain text
+UNSAFE_SCHEMES = ('javascript:', 'vbscript:', 'data:')
+
+DEFAULT_CSS = '''
+body { font-family: "DejaVu Sans", Verdana, sans-serif; max-width: 50em; margin: 0 auto; padding: 1em 2em; color: #222; }
+header { display: flex; justify-content: space-between; border-bottom: 2pt solid #222; padding-bottom: 0.3em; margin-bottom: 1em; }
+footer { border-top: 1pt solid #222; margin-top: 2em; padding-top: 0.3em; text-align: center; }
+footer img { height: 1cm; }
+a { color: blue; }
+code { font-family: "DejaVu Sans Mono", monospace; background: #F4F4F4; }
+blockquote { background: #fdf2f2; border: 1px solid #bf1f1f; border-radius: 4px; margin: 1em 0; padding: 0.5em 1em; }
+table { border-collapse: collapse; margin: 1em 0; }
+th { border-bottom: 1px solid #222; }
+th, td { padding: 0.2em 0.6em; }
+figure { margin: 1em 0; }
+figure img { max-width: 100%; }
+'''
+
+
+def data_uri(path:str) -> str:
+    mime = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    with open(path, 'rb') as f:
+        return f'data:{mime};base64,' + base64.b64encode(f.read()).decode('ascii')
+
+
+def render_link(match:re.Match) -> str:
+    text, url = match.group(1), match.group(2)
+    # The text is already escaped; quotes included, so the url cannot leave the attribute
+    scheme = re.sub(r'[\x00-\x20]', '', html.unescape(url)).lower()
+    if scheme.startswith(UNSAFE_SCHEMES):
+        return text
+    return f'<a href="{url}">{text}</a>'
+
+
+def render_inline(text:str) -> str:
+    text = html.escape(text, quote=True)
+    for pattern, replacement in INLINE_PATTERNS:
+        text = pattern.sub(replacement, text)
+    return LINK_PATTERN.sub(render_link, text)
+
+
+def render_image(match:re.Match, path:str) -> str:
+    alt, src, attributes = match.group(1), match.group(2), match.group(4) or ''
+    style = ''
+    width = re.search(r'width=([^\s}]+)', attributes)
+    if width:
+        style = f' style="width:{html.escape(width.group(1))}"'
+    return f'<figure><img alt="{html.escape(alt)}" src="{data_uri(os.path.join(path, src))}"{style}></figure>'
+
+
+def split_row(line:str) -> List[str]:
+    line = line.strip()
+    if line.startswith('|'): line = line[1:]
+    if line.endswith('|'): line = line[:-1]
+    return [cell.strip() for cell in line.split('|')]
+
+
+def render_table(lines:List[str]) -> str:
+    header = split_row(lines[0])
+    alignments = []
+    for cell in split_row(lines[1]):
+        if cell.startswith(':') and cell.endswith(':'): alignments.append('center')
+        elif cell.endswith(':'): alignments.append('right')
+        else: alignments.append('left')
+    def cells(row:List[str], tag:str) -> str:
+        return ''.join(
+            f'<{tag} style="text-align:{alignments[i] if i < len(alignments) else "left"}">{render_inline(cell)}</{tag}>'
+            for i, cell in enumerate(row)
+        )
+    rows = ''.join(f'<tr>{cells(split_row(line), "td")}</tr>' for line in lines[2:])
+    return f'<table><thead><tr>{cells(header, "th")}</tr></thead><tbody>{rows}</tbody></table>'
+
+
+def render_block(lines:List[str], path:str) -> str:
+    if len(lines) >= 2 and lines[0].lstrip().startswith('|') and set(lines[1].strip()) <= set('|:- '):
+        return render_table(lines)
+    if all(line.startswith('>') for line in lines):
+        return '<blockquote>' + render_block([line[1:].lstrip() for line in lines], path) + '</blockquote>'
+    output = []
+    paragraph = []
+    items = []
+    ordered = False
+    def flush():
+        if paragraph:
+            output.append('<p>' + render_inline(' '.join(paragraph)) + '</p>')
+            paragraph.clear()
+        if items:
+            tag = 'ol' if ordered else 'ul'
+            output.append(f'<{tag}>' + ''.join(f'<li>{render_inline(item)}</li>' for item in items) + f'</{tag}>')
+            items.clear()
+    for line in lines:
+        heading = HEADING_PATTERN.match(line)
+        image = IMAGE_PATTERN.match(line.strip())
+        item = LIST_PATTERN.match(line)
+        if heading:
+            flush()
+            level = len(heading.group(1))
+            output.append(f'<h{level}>{render_inline(heading.group(2))}</h{level}>')
+        elif image:
+            flush()
+            output.append(render_image(image, path))
+        elif item:
+            is_ordered = item.group(1)[0].isdigit()
+            if paragraph or (items and is_ordered != ordered): flush()
+            ordered = is_ordered
+            items.append(item.group(2))
+        elif items and line.startswith(' '):
+            items[-1] += ' ' + line.strip()
+        else:
+            if items: flush()
+            paragraph.append(line.strip())
+    flush()
+    return '\n'.join(output)
+
+
+def render_markdown(markdown:str, path:str) -> str:
+    output = []
+    lines : List[str] = []
+    for line in markdown.split('\n'):
+        if line.strip():
+            lines.append(line)
+        elif lines:
+            output.append(render_block(lines, path))
+            lines = []
+    if lines:
+        output.append(render_block(lines, path))
+    return '\n'.join(output)
+
+
+def render_table_block(block:blocks.Table) -> str:
+    # The block only keeps the shown rows and columns
+    output = block.df.to_html(index=block.index, border=0)
+    hidden = block.total_rows - block.shown_rows
+    if hidden > 0:
+        output += f'<p><em>{hidden} more rows</em></p>'
+    return output
+
+
+def render_blocks(report_blocks:List[blocks.Block], path:str, variables:dict, theme:dict) -> str:
+    '''
+    Same as `render`, working directly on the report blocks instead of parsing the markdown
+    '''
+    output = []
+    for block in report_blocks:
+        if isinstance(block, blocks.Heading):
+            output.append(f'<h{block.level}>{render_inline(block.text)}</h{block.level}>')
+        elif isinstance(block, blocks.Image):
+            style = f' style="width:{html.escape(block.width)}"'
+            output.append(f'<figure><img alt="" src="{data_uri(os.path.join(path, block.name))}"{style}></figure>')
+        elif isinstance(block, blocks.Table):
+            output.append(render_table_block(block))
+        else:
+            output.append(render_markdown(block.to_markdown(), path))
+    return page('\n'.join(output), variables, theme)
+
+
+def render(markdown:str, path:str, variables:dict, theme:dict) -> str:
+    '''
+    :param path workspace, images are read from there and embedded as base64
+    :param theme `css` and `images` (the `logo.jpg` goes to the footer) are used, if present
+    '''
+    return page(render_markdown(markdown, path), variables, theme)
+
+
+def page(body:str, variables:dict, theme:dict) -> str:
+    title = html.escape(variables.get('title', ''))
+    header = ''
+    if variables.get('title') or variables.get('date'):
+        header = f'<header><span>{title}</span><span>Generated at {html.escape(variables.get("date", ""))}</span></header>'
+    footer = ''
+    logo : Optional[str] = theme.get('images', {}).get('logo.jpg')
+    if logo:
+        footer = f'<footer><img alt="" src="data:image/jpeg;base64,{logo}"></footer>'
+    return (
+        '<!DOCTYPE html>\n'
+        f'<html><head><meta charset="utf-8"><title>{title}</title>'
+        f'<meta name="author" content="{html.escape(variables.get("author", ""))}">'
+        f'<meta name="keywords" content="{html.escape(variables.get("keywords", ""))}">'
+        f'<style>{theme.get("css", DEFAULT_CSS)}</style></head>\n'
+        f'<body>{header}\n' + body + f'\n{footer}</body></html>\n'
+    )
@@ -0,0 +1,131 @@
+'''
+Per-stage timing of a report build (each `add_*` call and each phase of `save`)
+'''
+import logging
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+
+@dataclass
+class StageStats:
+    '''
+    `cpu_seconds` is the CPU time of the thread running the stage, so concurrent stages in other threads
+    (eg: figure workers) are not counted in it; subprocesses are not counted either
+    `subprocess_max_rss_kb` is the peak memory of the largest subprocess (eg: xelatex) run by `runner.run`
+    during the stage, measured for that process alone; None if the stage ran no subprocess
+    '''
+    name : str
+    wall_seconds : float = 0.0
+    cpu_seconds : float = 0.0
+    bytes_written : int = 0
+    subprocess_max_rss_kb : Optional[int] = None
+    labels : Dict[str, str] = field(default_factory=dict)
+
+
+# Stage being measured in the current thread, if any
+_current_stage : ContextVar[Optional[StageStats]] = ContextVar('paperdash_stage', default=None)
+
+
+def record_subprocess(rusage:Any) -> None:
+    '''
+    Called by `runner.run` with the resource usage (`os.wait4`) of each finished command
+    '''
+    record = _current_stage.get()
+    if record is not None:
+        record.subprocess_max_rss_kb = max(record.subprocess_max_rss_kb or 0, rusage.ru_maxrss)
+
+
+class ReportStats():
+    '''
+    Collects a `StageStats` for each stage; pass it to `StaticReport(stats=...)`
+    Each finished stage is logged (debug level) and passed to the callbacks
+    '''
+    def __init__(
+        self,
+        callbacks:List[Callable[[StageStats], None]]=[],
+        logger:logging.Logger=logging.getLogger('paperdash'),
+    ):
+        self.callbacks = list(callbacks)
+        self.logger = logger
+        self.records : List[StageStats] = []
+
+    def __getstate__(self) -> dict:
+        # Callbacks may not be picklable (eg: lambdas); they stay in the parent process
+        return {'records': self.records}
+
+    def __setstate__(self, state:dict) -> None:
+        self.__init__()
+        self.records = state['records']
+
+    @contextmanager
+    def stage(self, name:str, **labels:str) -> Iterator[StageStats]:
+        '''
+        Measure the code inside the `with`; set `bytes_written` on the yielded record
+        '''
+        record = StageStats(name=name, labels=labels)
+        token = _current_stage.set(record)
+        wall_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        try:
+            yield record
+        finally:
+            record.wall_seconds = time.perf_counter() - wall_start
+            record.cpu_seconds = time.thread_time() - cpu_start
+            _current_stage.reset(token)
+            self.records.append(record)
+            self.logger.debug(
+                '%s: %.3fs wall, %.3fs cpu, %d bytes written',
+                name, record.wall_seconds, record.cpu_seconds, record.bytes_written,
+            )
+            for callback in self.callbacks:
+                callback(record)
+
+    def summary(self) -> Dict[str, dict]:
+        '''
+        Totals by stage name
+        '''
+        totals : Dict[str, dict] = {}
+        for record in self.records:
+            total = totals.setdefault(record.name, {
+                'count': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'bytes_written': 0, 'subprocess_max_rss_kb': None,
+            })
+            total['count'] += 1
+            total['wall_seconds'] += record.wall_seconds
+            total['cpu_seconds'] += record.cpu_seconds
+            total['bytes_written'] += record.bytes_written
+            if record.subprocess_max_rss_kb is not None:
+                total['subprocess_max_rss_kb'] = max(total['subprocess_max_rss_kb'] or 0, record.subprocess_max_rss_kb)
+        return totals
+
+    def to_prometheus(self, path:Optional[str]=None, prefix:str='paperdash') -> str:
+        '''
+        Totals in the Prometheus text format; if `path` is given, it is written there
+        atomically (as expected by the node_exporter textfile collector)
+        '''
+        metrics = [
+            ('count', 'stages_total', 'counter', 'Number of times the stage ran'),
+            ('wall_seconds', 'stage_wall_seconds_total', 'counter', 'Wall time spent in the stage'),
+            ('cpu_seconds', 'stage_cpu_seconds_total', 'counter', 'CPU time of the thread running the stage'),
+            ('bytes_written', 'stage_written_bytes_total', 'counter', 'Bytes written by the stage'),
+            ('subprocess_max_rss_kb', 'stage_subprocess_max_rss_kilobytes', 'gauge', 'Peak memory of the largest subprocess of the stage'),
+        ]
+        summary = self.summary()
+        lines = []
+        for key, name, kind, description in metrics:
+            lines.append(f'# HELP {prefix}_{name} {description}')
+            lines.append(f'# TYPE {prefix}_{name} {kind}')
+            for stage, total in summary.items():
+                if total[key] is not None:
+                    lines.append(f'{prefix}_{name}{{stage="{stage}"}} {total[key]}')
+        text = '\n'.join(lines) + '\n'
+        if path:
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix='.tmp_')
+            with os.fdopen(fd, 'w') as f:
+                f.write(text)
+            os.replace(temp_path, path)
+        return text
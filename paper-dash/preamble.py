@@ -0,0 +1,172 @@
+'''
+Compile the PDF with a precompiled preamble (mylatexformat)
+
+pandoc only generates the LaTeX; the static theme headers (the ones without `$variable$`) are moved
+right after `\\documentclass` and followed by `\\endofdump`. Everything up to that point is dumped once
+by `xelatex -ini` into a format file, cached by the hash of that text, and later compiles load the
+format instead of parsing those packages again.
+Fonts (fontspec) cannot be dumped by xelatex, that is why the dump stops before the pandoc template
+preamble, and variable-dependent headers (`$title$`, `$date$`, etc.) stay after the dump.
+Format files only load in the exact xelatex build that dumped them, so the version is part of the cache key;
+if anything in this path fails, the report is compiled again the usual way, by pandoc alone.
+'''
+import functools
+import logging
+import os
+import re
+import shutil
+from typing import List, Optional, Tuple
+from paperdash import runner
+from paperdash.runner import CommandError
+from paperdash.cache import FileCache, content_hash, link_or_copy
+from paperdash.template import PLACEHOLDER_PATTERN
+
+DOCUMENTCLASS_PATTERN = re.compile(r'\\documentclass\s*(\[[^\]]*\])?\s*\{[^}]*\}')
+END_OF_DUMP = '\\csname endofdump\\endcsname'
+FORMAT_NAME = 'preamble'
+# Like pandoc, stop rerunning xelatex after this many runs even if it still asks for it
+MAX_RUNS = 4
+# Intermediate files left in the workspace, removed so they are not packaged with the report
+ARTIFACTS = ['report.tex', 'report.aux', 'report.log', 'report.toc', 'report.out', 'report.pdf', f'{FORMAT_NAME}.fmt', f'{FORMAT_NAME}.log']
+
+
+def is_static(text:str) -> bool:
+    '''
+    True if the text does not depend on any report variable
+    '''
+    return PLACEHOLDER_PATTERN.search(text) is None
+
+
+def split_static_headers(argv:List[str], files:dict) -> Tuple[List[str], List[str]]:
+    '''
+    Remove from the pandoc `argv` the `--include-in-header` of static theme files
+    Return the new argv and the names of the removed files, in order and without repetitions
+    '''
+    new_argv = []
+    static = []
+    i = 0
+    while i < len(argv):
+        if argv[i] == '--include-in-header' and i + 1 < len(argv) and argv[i+1] in files and is_static(files[argv[i+1]]):
+            if argv[i+1] not in static:
+                static.append(argv[i+1])
+            i += 2
+            continue
+        new_argv.append(argv[i])
+        i += 1
+    return new_argv, static
+
+
+def inject_static_headers(tex:str, headers:str) -> Tuple[str, str]:
+    '''
+    Insert the static headers and the end of dump marker after `\\documentclass`
+    Return the dumped part (up to the marker) and the remaining of the document
+    '''
+    match = DOCUMENTCLASS_PATTERN.search(tex)
+    if not match:
+        raise ValueError('Could not find \\documentclass in the generated LaTeX')
+    prefix = tex[:match.end()] + '\n' + headers + '\n' + END_OF_DUMP + '\n'
+    return prefix, tex[match.end():]
+
+
+@functools.lru_cache(maxsize=None)
+def xelatex_version() -> str:
+    return runner.run(['xelatex', '--version'], timeout=60).stdout
+
+
+def compile_pdf(
+    path:str,
+    argv:List[str],
+    files:dict,
+    out_path:str,
+    format_cache:FileCache,
+    toc:bool=False,
+    timeout:Optional[float]=600,
+) -> None:
+    '''
+    Compile `report.md` in the workspace `path` to `out_path`, reusing a cached format for the static preamble
+    `argv` is the pandoc command (without output options), `files` the theme files
+    If the format cannot be dumped or loaded (eg: mylatexformat is not installed), the PDF is compiled
+    by pandoc without it; timeouts are raised
+    '''
+    try:
+        _compile_with_format(path, argv, files, out_path, format_cache, toc, timeout)
+    except (CommandError, ValueError) as error:
+        if isinstance(error, CommandError) and error.timed_out:
+            raise
+        logging.warning('Compiling with a precompiled preamble failed, compiling without it: %s', error)
+        runner.run(argv + ['-o', out_path], cwd=path, timeout=timeout)
+    finally:
+        remove_artifacts(path, keep=out_path)
+
+
+def remove_artifacts(path:str, keep:Optional[str]=None) -> None:
+    for name in ARTIFACTS:
+        artifact = os.path.join(path, name)
+        if os.path.exists(artifact) and not (keep and os.path.abspath(artifact) == os.path.abspath(keep)):
+            os.remove(artifact)
+
+
+def needs_rerun(path:str) -> bool:
+    '''
+    True if the last xelatex run asked for another one (eg: to resolve labels or references)
+    '''
+    try:
+        with open(f'{path}/report.log', 'r', encoding='utf-8', errors='replace') as f:
+            return any('Rerun' in line for line in f)
+    except FileNotFoundError:
+        return False
+
+
+def _compile_with_format(
+    path:str,
+    argv:List[str],
+    files:dict,
+    out_path:str,
+    format_cache:FileCache,
+    toc:bool,
+    timeout:Optional[float],
+) -> None:
+    argv, static_headers = split_static_headers(argv, files)
+    argv = [arg for arg in argv if not arg.startswith('--pdf-engine')]
+    runner.run(argv + ['--standalone', '--to', 'latex', '-o', 'report.tex'], cwd=path, timeout=timeout)
+
+    headers = ''
+    for name in static_headers:
+        with open(f'{path}/{name}', 'r') as f:
+            headers += f.read() + '\n'
+    with open(f'{path}/report.tex', 'r') as f:
+        prefix, body = inject_static_headers(f.read(), headers)
+    with open(f'{path}/report.tex', 'w') as f:
+        f.write(prefix + body)
+
+    key = content_hash(xelatex_version(), prefix) + '.fmt'
+    format_path = f'{path}/{FORMAT_NAME}.fmt'
+    if os.path.exists(format_path):
+        os.remove(format_path)
+    cached_path = format_cache.get(key)
+    if cached_path:
+        try:
+            link_or_copy(cached_path, format_path)
+        except FileNotFoundError:
+            # Evicted in the meantime
+            cached_path = None
+    if not cached_path:
+        runner.run(
+            ['xelatex', '-ini', '-interaction=nonstopmode', '-halt-on-error', f'-jobname={FORMAT_NAME}', '&xelatex', 'mylatexformat.ltx', 'report.tex'],
+            cwd=path,
+            timeout=timeout,
+        )
+        format_cache.put_file(key, format_path)
+
+    command = ['xelatex', '-interaction=nonstopmode', '-halt-on-error', f'-fmt={FORMAT_NAME}', 'report.tex']
+    # The table of contents always needs a second run, references and labels ask for one in the log
+    try:
+        runs = 0
+        while runs == 0 or (runs < MAX_RUNS and ((toc and runs < 2) or needs_rerun(path))):
+            runner.run(command, cwd=path, timeout=timeout)
+            runs += 1
+    except CommandError:
+        # Do not keep reusing a format that may be the cause
+        format_cache.remove(key)
+        raise
+    shutil.move(f'{path}/report.pdf', out_path)
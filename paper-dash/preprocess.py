@@ -0,0 +1,48 @@
+'''
+Line by line transformations of the markdown, applied as a stream: each filter takes the lines
+(with their line endings) and yields the output lines, so any file size is processed with constant memory
+'''
+import os
+import tempfile
+from typing import Callable, Iterable, Iterator, List
+
+Filter = Callable[[Iterable[str]], Iterator[str]]
+
+MANUAL_START = '==[MANUAL]=='
+MANUAL_END = '==[END OF MANUAL]=='
+
+
+def strip_manual(lines:Iterable[str]) -> Iterator[str]:
+    '''
+    Remove the manual sections: the lines between `==[MANUAL]==` and `==[END OF MANUAL]==`, markers included
+    '''
+    in_manual = False
+    for line in lines:
+        if MANUAL_START in line:
+            in_manual = True
+        elif MANUAL_END in line:
+            in_manual = False
+        elif not in_manual:
+            yield line
+
+
+def apply(lines:Iterable[str], filters:List[Filter]) -> Iterator[str]:
+    for f in filters:
+        lines = f(lines)
+    return iter(lines)
+
+
+def process_file(src:str, dst:str, filters:List[Filter]) -> None:
+    '''
+    Stream `src` through the filters into `dst`; both can be the same file,
+    in which case the output is written to a temporary file and renamed over it
+    '''
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(dst)), prefix='.tmp_')
+    try:
+        with open(src, 'r', encoding='utf-8', newline='') as f_in, os.fdopen(fd, 'w', encoding='utf-8', newline='') as f_out:
+            f_out.writelines(apply(f_in, filters))
+        os.replace(temp_path, dst)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
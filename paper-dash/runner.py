@@ -0,0 +1,113 @@
+import logging
+import os
+import signal
+import subprocess
+from typing import Dict, List, Optional, Tuple
+from paperdash import instrumentation
+
+
+class CommandError(Exception):
+    '''
+    External command failed or timed out
+    The captured output is kept, so the cause (eg: the LaTeX error) can be inspected
+    '''
+    def __init__(
+        self,
+        argv:List[str],
+        returncode:Optional[int],
+        stdout:str,
+        stderr:str,
+        timed_out:bool=False,
+    ):
+        self.argv = argv
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.timed_out = timed_out
+        if timed_out:
+            reason = 'timed out'
+        else:
+            reason = f'exited with code {returncode}'
+        message = f'`{argv[0]}` {reason}'
+        if stderr.strip():
+            message += '\n' + stderr.strip()[-2000:]
+        super().__init__(message)
+
+    def __reduce__(self):
+        return (CommandError, (self.argv, self.returncode, self.stdout, self.stderr, self.timed_out))
+
+
+class _Process(subprocess.Popen):
+    '''
+    Popen that reaps the process with `os.wait4`, keeping its own resource usage in `rusage`
+    '''
+    rusage = None
+
+    def _try_wait(self, wait_flags):
+        if not hasattr(os, 'wait4'):
+            return super()._try_wait(wait_flags)
+        try:
+            pid, status, rusage = os.wait4(self.pid, wait_flags)
+        except ChildProcessError:
+            return super()._try_wait(wait_flags)
+        if pid == self.pid:
+            self.rusage = rusage
+        return pid, status
+
+
+def run(
+    argv:List[str],
+    cwd:Optional[str]=None,
+    timeout:Optional[float]=None,
+    env:Optional[Dict[str, str]]=None,
+) -> subprocess.CompletedProcess:
+    '''
+    Run a command without a shell, capturing its output
+    On timeout, or if interrupted (eg: KeyboardInterrupt), the whole process group is killed and reaped,
+    so children (eg: xelatex started by pandoc) do not survive
+    Raise `CommandError` if the command fails or times out
+    The peak memory of the command is added to the stage being measured (see `instrumentation`)
+    '''
+    logging.debug('Running %s', argv)
+    process = _Process(
+        argv,
+        cwd=cwd,
+        env=env,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        start_new_session=True,
+    )
+    try:
+        stdout, stderr = process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        stdout, stderr = _kill(process)
+        raise CommandError(argv, None, stdout.decode(errors='replace'), stderr.decode(errors='replace'), timed_out=True)
+    except BaseException:
+        # eg: KeyboardInterrupt, or SystemExit raised by a signal handler
+        _kill(process)
+        raise
+    _record(process)
+    stdout = stdout.decode(errors='replace')
+    stderr = stderr.decode(errors='replace')
+    if process.returncode != 0:
+        raise CommandError(argv, process.returncode, stdout, stderr)
+    return subprocess.CompletedProcess(argv, process.returncode, stdout, stderr)
+
+
+def _kill(process:_Process) -> Tuple[bytes, bytes]:
+    '''
+    Kill the process group of the command and reap it, returning the output captured so far
+    '''
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    stdout, stderr = process.communicate()
+    _record(process)
+    return stdout, stderr
+
+
+def _record(process:_Process) -> None:
+    if process.rusage is not None:
+        instrumentation.record_subprocess(process.rusage)
@@ -0,0 +1,168 @@
+'''
+Themes compiled once per process: the `$variable$` placeholders are tokenized, the images decoded,
+and the files that do not depend on variables are written once to a shared folder,
+from where they are hardlinked into each report workspace
+'''
+import base64
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+from paperdash.cache import content_hash
+
+PLACEHOLDER_PATTERN = re.compile(r'\$([A-Za-z_][\w-]*)\$')
+
+LATEX_SPECIAL_CHARACTERS = {
+    '\\': r'\textbackslash{}',
+    '&': r'\&',
+    '%': r'\%',
+    '$': r'\$',
+    '#': r'\#',
+    '_': r'\_',
+    '{': r'\{',
+    '}': r'\}',
+    '~': r'\textasciitilde{}',
+    '^': r'\textasciicircum{}',
+}
+LATEX_ESCAPE_TABLE = str.maketrans(LATEX_SPECIAL_CHARACTERS)
+
+
+def latex_escape(text:str) -> str:
+    return text.translate(LATEX_ESCAPE_TABLE)
+
+
+def json_escape(text:str) -> str:
+    return json.dumps(text)[1:-1]
+
+
+def escape_for(filename:str) -> Optional[Callable[[str], str]]:
+    '''
+    How variable values should be escaped in a given output file, based on its extension
+    '''
+    if filename.endswith('.tex'):
+        return latex_escape
+    if filename.endswith('.theme') or filename.endswith('.json'):
+        return json_escape
+    return None
+
+
+class Template():
+    '''
+    Text split into literals (even positions) and variable names (odd positions)
+    '''
+    __slots__ = ('tokens',)
+
+    def __init__(self, text:str):
+        self.tokens : List[str] = PLACEHOLDER_PATTERN.split(text)
+
+    @property
+    def variables(self) -> List[str]:
+        return self.tokens[1::2]
+
+    @property
+    def is_static(self) -> bool:
+        return len(self.tokens) == 1
+
+    def render(self, variables:dict, escape:Optional[Callable[[str], str]]=None) -> str:
+        '''
+        One pass over the tokens, independent of the number of variables
+        Placeholders without a value are kept as they are
+        '''
+        output = []
+        for i, token in enumerate(self.tokens):
+            if i % 2 == 0:
+                output.append(token)
+            elif token in variables:
+                value = str(variables[token])
+                output.append(escape(value) if escape else value)
+            else:
+                output.append('$' + token + '$')
+        return ''.join(output)
+
+
+class CompiledTheme():
+    def __init__(self, theme:dict, cache_root:str):
+        self.theme = theme
+        self.key = content_hash(json.dumps({'files': theme['files'], 'images': theme['images']}, sort_keys=True))
+        self.templates : Dict[str, Template] = {name: Template(text) for name, text in theme['files'].items()}
+        self.escapes = {name: escape_for(name) for name in self.templates}
+        self.required_variables : List[str] = theme.get('required_variables', [])
+        self.static = [name for name, template in self.templates.items() if template.is_static] + list(theme['images'])
+        self.path = os.path.abspath(f'{cache_root}/{self.key}')
+        if not os.path.exists(self.path):
+            self._write_static(cache_root)
+
+    def _write_static(self, cache_root:str) -> None:
+        # Written to a temporary folder and renamed, so other processes never see it incomplete
+        os.makedirs(cache_root, exist_ok=True)
+        temp_path = tempfile.mkdtemp(prefix='.tmp_', dir=cache_root)
+        for name, template in self.templates.items():
+            if template.is_static:
+                with open(f'{temp_path}/{name}', 'w') as f:
+                    f.write(template.tokens[0])
+        for name, content in self.theme['images'].items():
+            with open(f'{temp_path}/{name}', 'wb') as f:
+                f.write(base64.b64decode(content))
+        try:
+            os.rename(temp_path, self.path)
+        except OSError:
+            # Another process was faster
+            shutil.rmtree(temp_path)
+
+    def missing_variables(self, variables:dict) -> List[str]:
+        return [name for name in self.required_variables if name not in variables]
+
+    def materialize(self, path:str, variables:dict, strict:bool=False) -> int:
+        '''
+        Put all the theme files in the workspace `path`
+        Static files and images are hardlinked from the shared folder, only the others are rendered,
+        with the values escaped for the file type (eg: LaTeX special characters in `.tex` files)
+        Missing `required_variables` raise `ValueError` if `strict`, otherwise they are logged
+        Return the number of bytes written (hardlinks write none)
+        '''
+        missing = self.missing_variables(variables)
+        if missing:
+            if strict:
+                raise ValueError(f'Missing required variables: {", ".join(missing)}')
+            logging.warning('Missing required variables: %s', ', '.join(missing))
+        if not os.path.exists(self.path):
+            self._write_static(os.path.dirname(self.path))
+        written = 0
+        for name in self.static:
+            src, dst = f'{self.path}/{name}', f'{path}/{name}'
+            if os.path.exists(dst):
+                if os.path.samefile(src, dst):
+                    continue
+                os.remove(dst)
+            try:
+                os.link(src, dst)
+            except OSError:
+                shutil.copyfile(src, dst)
+                written += os.path.getsize(dst)
+        for name, template in self.templates.items():
+            if not template.is_static:
+                with open(f'{path}/{name}', 'w') as f:
+                    f.write(template.render(variables, self.escapes[name]))
+                    written += f.tell()
+        return written
+
+
+_compiled : Dict[Tuple[int, str], CompiledTheme] = {}
+_compiled_lock = threading.Lock()
+
+def compile_theme(theme:dict, cache_root:str) -> CompiledTheme:
+    '''
+    Compile the theme, or return the already compiled one
+    Themes are expected to not change after the first use
+    '''
+    key = (id(theme), os.path.abspath(cache_root))
+    with _compiled_lock:
+        compiled = _compiled.get(key)
+        if compiled is None or compiled.theme is not theme:
+            compiled = CompiledTheme(theme, cache_root)
+            _compiled[key] = compiled
+    return compiled
@@ -1,11 +1,11 @@
-from typing import Callable, Optional, Tuple, List, Dict, Union
+from typing import BinaryIO, Callable, Iterable, Iterator, Optional, Tuple, List, Dict, Union
 import datetime
-import pandas as pd
-import pytz
+import functools
+import os
 import re
-
-from requests import delete
 import logging
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, ThreadPoolExecutor, wait
+from uuid import uuid4
 
 def datetime_ago(
     window_days: int, 
@@ -83,8 +83,101 @@ def str_match_prefixes(s, prefixes:List[str], case_sensitive:bool=True) -> bool:
 ####
 ## Azure storage
 # Version 0.1.0
+# azure.storage.blob is imported inside the functions, so importing utils stays fast
+# Clients are created once per connection string and container, and shared (they are thread safe),
+# so all the calls reuse the same HTTP connection pool
+# Also works with the local emulator (Azurite), using its connection string
+
+# Maximum number of simultaneous requests of the bulk operations
+MAX_CONCURRENCY = 16
+# Maximum number of operations in one batch request (limit of the service)
+BATCH_SIZE = 256
+# Size of the chunks of the streaming uploads
+BLOCK_SIZE = 4 * 1024 * 1024
+
+@functools.lru_cache(maxsize=None)
+def blob_service_client(connection_string:str, block_size:Optional[int]=None):
+    '''
+    :param block_size if given, downloads request at most this many bytes at a time (the default is 32 MiB
+        for the first request and 4 MiB for the next ones); these are client settings, not per call
+    '''
+    from azure.storage.blob import BlobServiceClient
+    if block_size:
+        return BlobServiceClient.from_connection_string(
+            connection_string,
+            max_single_get_size=block_size,
+            max_chunk_get_size=block_size,
+        )
+    return BlobServiceClient.from_connection_string(connection_string)
+
+@functools.lru_cache(maxsize=None)
+def blob_container_client(connection_string:str, container:str, block_size:Optional[int]=None):
+    return blob_service_client(connection_string, block_size).get_container_client(container)
+
+def blob_clear_clients() -> None:
+    '''
+    Forget the shared clients; call it in a forked process, so it opens its own connections
+    '''
+    blob_container_client.cache_clear()
+    blob_service_client.cache_clear()
+
+def blob_client(connection_string:str, container:str, filename:str, block_size:Optional[int]=None):
+    '''
+    Client for a single blob, sharing the connection pool of its container
+    '''
+    return blob_container_client(connection_string, container, block_size).get_blob_client(filename)
+
+def imap_concurrent(function:Callable, items:Iterable, max_concurrency:int=MAX_CONCURRENCY) -> Iterator[Tuple]:
+    '''
+    Call `function(item)` for all the items, at most `max_concurrency` at the same time,
+    yielding `(item, result)` as they finish, where the result is the raised exception if the call failed
+    `items` is consumed lazily, at most `2 * max_concurrency` ahead of the finished calls
+    '''
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        futures = {}
+        for item in items:
+            futures[executor.submit(function, item)] = item
+            if len(futures) >= 2 * max_concurrency:
+                yield from _collect(futures, wait_all=False)
+        yield from _collect(futures, wait_all=True)
+
+def map_concurrent(function:Callable, items:Iterable, max_concurrency:int=MAX_CONCURRENCY) -> Dict:
+    '''
+    Same as `imap_concurrent`, returning `item -> result`
+    '''
+    return dict(imap_concurrent(function, items, max_concurrency))
+
+def _collect(futures:dict, wait_all:bool) -> Iterator[Tuple]:
+    done, _ = wait(futures, return_when=ALL_COMPLETED if wait_all else FIRST_COMPLETED)
+    for future in done:
+        item = futures.pop(future)
+        error = future.exception()
+        yield item, error if error else future.result()
+
+def distinct_prefixes(prefixes:Iterable[str]) -> List[str]:
+    '''
+    Sorted prefixes, without the ones already covered by a shorter prefix
+    '''
+    result = []
+    for prefix in sorted(set(prefixes)):
+        if not result or not prefix.startswith(result[-1]):
+            result.append(prefix)
+    return result
+#assert distinct_prefixes(['final/', 'draft/b', 'draft/']) == ['draft/', 'final/']
 
-from azure.storage.blob import BlobServiceClient, BlobClient, generate_blob_sas, BlobSasPermissions
+def blob_list(connection_string:str, container:str, prefixes:Optional[List[str]]=None, include:Optional[List[str]]=None) -> Iterator:
+    '''
+    Lazily list the blobs (`BlobProperties`) whose name starts with any of the prefixes, or all of them
+    The filter is done by the service, with one listing per distinct prefix, so only the matching blobs
+    are transferred; pages are requested as the generator is consumed
+    :param include extra details returned with each blob (eg: `['metadata']`)
+    '''
+    container_client = blob_container_client(connection_string, container)
+    if not prefixes:
+        yield from container_client.list_blobs(include=include)
+        return
+    for prefix in distinct_prefixes(prefixes):
+        yield from container_client.list_blobs(name_starts_with=prefix, include=include)
 
 def conn_string2account_key(connection_string:str) -> str:
     pattern = f';AccountKey=(.*?);'
@@ -100,23 +193,87 @@ def conn_string2account_name(connection_string:str) -> str:
         raise ValueError('Invalid connection string')
     return result[0]
 
-def blob_upload(connection_string:str, container:str, filename:str, content:Union[bytes, str], overwrite: bool = False) -> dict:
-    if blob_exists(connection_string, container, filename):
-        if overwrite:
-            logging.info('Overwriting existing file')
-            blob_delete(container, connection_string, filename)
-        else:
-            raise Exception('File already exists')
-    blob_client = BlobClient.from_connection_string(connection_string, container, filename)
-    r = blob_client.upload_blob(content)
+def blob_upload(connection_string:str, container:str, filename:str, content:Union[bytes, str, BinaryIO], overwrite: bool = False, metadata:Optional[Dict[str, str]]=None) -> dict:
+    '''
+    :param content bytes, text or a binary file object; file objects are streamed (see `blob_upload_stream`)
+    :param metadata stored with the blob (see `blob_properties`)
+    A single request: an existing blob is replaced atomically if `overwrite`,
+    otherwise the upload is conditional (If-None-Match: *) and raises `FileExistsError`
+    '''
+    from azure.core.exceptions import ResourceExistsError
+    try:
+        if hasattr(content, 'read'):
+            return blob_upload_stream(connection_string, container, filename, content, overwrite=overwrite, metadata=metadata)
+        r = blob_client(connection_string, container, filename).upload_blob(content, overwrite=overwrite, metadata=metadata)
+    except ResourceExistsError as error:
+        raise FileExistsError('File already exists') from error
     return r
 
+def blob_upload_stream(
+    connection_string:str,
+    container:str,
+    filename:str,
+    f:BinaryIO,
+    overwrite:bool=True,
+    block_size:int=BLOCK_SIZE,
+    max_concurrency:int=MAX_CONCURRENCY,
+    **kwargs
+) -> dict:
+    '''
+    Upload from a file object `block_size` bytes at a time, staging up to `max_concurrency` blocks in parallel,
+    then committing the block list; memory used is bounded by `block_size * max_concurrency`, whatever the size
+    Content smaller than one block is uploaded in a single request
+    kwargs are passed to `upload_blob`/`commit_block_list` (eg: `metadata`)
+    '''
+    from azure.core import MatchConditions
+    from azure.storage.blob import BlobBlock
+    client = blob_client(connection_string, container, filename)
+    data = f.read(block_size)
+    if len(data) < block_size:
+        return client.upload_blob(data, overwrite=overwrite, **kwargs)
+    if not overwrite:
+        kwargs.update(etag='*', match_condition=MatchConditions.IfMissing)
+
+    # Uncommitted blocks of a blob are shared by all its writers: a prefix unique to this upload
+    # keeps concurrent uploads of the same blob from committing each other's blocks
+    upload_id = uuid4().hex
+    block_ids = []
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        pending = set()
+        while data:
+            # Fixed length ids, as required by the service
+            block_id = f'{upload_id}{len(block_ids):08d}'
+            block_ids.append(block_id)
+            pending.add(executor.submit(client.stage_block, block_id, data))
+            if len(pending) >= max_concurrency:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+            data = f.read(block_size)
+        for future in pending:
+            future.result()
+    return client.commit_block_list([BlobBlock(block_id) for block_id in block_ids], **kwargs)
+
+
+def blob_properties(connection_string:str, container:str, filename:str):
+    '''
+    Properties of the blob (`etag`, `last_modified`, `metadata`, etc.), or None if it does not exist
+    '''
+    from azure.core.exceptions import ResourceNotFoundError
+    try:
+        return blob_client(connection_string, container, filename).get_blob_properties()
+    except ResourceNotFoundError:
+        return None
 
 def blob_exists(connection_string:str, container:str, filename:str) -> bool:
-    blob_client = BlobClient.from_connection_string(connection_string, container, filename)
-    return blob_client.exists()
+    '''
+    Prefer trying the operation and handling the error: a probe is an extra round trip
+    and the blob can be created or deleted right after it
+    '''
+    return blob_client(connection_string, container, filename).exists()
 
 def blob_download_link(connection_string, container, filename, hours=1):
+    from azure.storage.blob import generate_blob_sas, BlobSasPermissions
     account_name = conn_string2account_name(connection_string)
     sas_blob = generate_blob_sas(
         account_name=account_name, 
@@ -126,121 +283,178 @@ def blob_download_link(connection_string, container, filename, hours=1):
         permission=BlobSasPermissions(read=True),
         expiry=datetime.datetime.utcnow() + datetime.timedelta(hours=hours)
     )
-    url = 'https://'+account_name+'.blob.core.windows.net/'+container+'/'+filename+'?'+sas_blob
+    url = blob_client(connection_string, container, filename).url+'?'+sas_blob
     return url
 
-def blob_upload_and_generate_link(connection_string:str, container:str, filename:str, content:Union[bytes, str], hours:int=1, overwrite: bool = False) -> str:
-    r = blob_upload(connection_string, container, filename, content, overwrite=overwrite)
+def blob_upload_and_generate_link(connection_string:str, container:str, filename:str, content:Union[bytes, str, BinaryIO], hours:int=1, overwrite: bool = False, metadata:Optional[Dict[str, str]]=None) -> str:
+    r = blob_upload(connection_string, container, filename, content, overwrite=overwrite, metadata=metadata)
     if not r:
         raise Exception('Could not upload file')
     url = blob_download_link(connection_string, container, filename, hours=hours)
     return url
 
-def blob_reupload(container:str, connection_string:str, filename:str) -> bytes:
+def blob_refresh(connection_string:str, container:str, filename:str, block_size:int=BLOCK_SIZE, max_concurrency:int=1) -> dict:
     '''
-    Download, delete and reupload blob
-    This function can potencially cause data loss: if the upload fail, the blob is gone
-    The blob content is returned, in case you want to handle this error
+    Rewrite the blob with its own content (eg: to update its last modified date), streamed chunk by chunk
+    The content is staged as uncommitted blocks of the same blob and committed at the end, only if the blob
+    was not modified in the meantime (If-Match), so the old version is there until the new one replaces it
+    Metadata and content settings are kept
     '''
-    blob_client = BlobClient.from_connection_string(connection_string, container, filename)
-    content = blob_client.download_blob().readall()
-    assert content!=None
-    try:
-        blob_client.delete_blob()
-        r = blob_client.upload_blob(content)
-        assert r!=None
-    except:
-        pass
-    return content
+    from azure.core import MatchConditions
+    # Downloaded `block_size` bytes at a time too; by default the first request alone buffers up to 32 MiB
+    downloader = blob_client(connection_string, container, filename, block_size).download_blob()
+    properties = downloader.properties
+    return blob_upload_stream(
+        connection_string, container, filename, downloader,
+        block_size=block_size,
+        max_concurrency=max_concurrency,
+        etag=properties.etag,
+        match_condition=MatchConditions.IfNotModified,
+        metadata=properties.metadata,
+        content_settings=properties.content_settings,
+    )
+
+def blob_refresh_many(connection_string:str, container:str, filenames:Iterable[str], max_concurrency:int=MAX_CONCURRENCY) -> Dict[str, Optional[Exception]]:
+    '''
+    `blob_refresh` the blobs, `max_concurrency` at the same time (each one streamed, one block at a time)
+    Return `filename -> None` if it was refreshed, or the exception otherwise; failures do not stop the others
+    '''
+    def refresh(filename:str) -> None:
+        blob_refresh(connection_string, container, filename)
+    results = map_concurrent(refresh, filenames, max_concurrency)
+    for filename, result in results.items():
+        if isinstance(result, Exception):
+            logging.warning('Could not refresh %s: %s', filename, result)
+    return results
+
+def blob_reupload(container:str, connection_string:str, filename:str) -> dict:
+    '''
+    Reupload the blob with its own content; see `blob_refresh`
+    '''
+    return blob_refresh(connection_string, container, filename)
     
 def blob_delete(container:str, connection_string:str, filename:str) -> None:
-    blob_client = BlobClient.from_connection_string(connection_string, container, filename)
-    blob_client.delete_blob()
+    blob_client(connection_string, container, filename).delete_blob()
 
-def blob_delete_all(connection_string:str, container:str, prefixes:List[str]=None):
-    blob_service_client = BlobServiceClient.from_connection_string(connection_string)
-    container_client = blob_service_client.get_container_client(container)
+def blob_delete_many(connection_string:str, container:str, filenames:Iterable[str], max_concurrency:int=MAX_CONCURRENCY) -> int:
+    '''
+    Delete the blobs using batch requests (up to `BATCH_SIZE` deletes each), several batches at the same time
+    Every failed delete is logged; once all the batches are done, an exception with the failed names is raised
+    Return the number of deleted blobs
+    '''
+    container_client = blob_container_client(connection_string, container)
+    def delete_batch(batch:Tuple[str, ...]) -> List[str]:
+        # Responses come in the same order as the names
+        responses = container_client.delete_blobs(*batch, raise_on_any_failure=False)
+        failed = []
+        for filename, response in zip(batch, responses):
+            if response.status_code >= 300:
+                logging.warning('Could not delete %s: status %d', filename, response.status_code)
+                failed.append(filename)
+        return failed
+    def batches() -> Iterator[Tuple[str, ...]]:
+        # Lazy, so the deletes start while the names are still being listed
+        batch = []
+        for filename in filenames:
+            batch.append(filename)
+            if len(batch) == BATCH_SIZE:
+                yield tuple(batch)
+                batch = []
+        if batch:
+            yield tuple(batch)
     total = 0
-    for blob in container_client.list_blobs():
-        if prefixes and not str_match_prefixes(blob.name, prefixes):
-            continue
-        total += 1
-        blob_delete(connection_string=connection_string, container=container, filename=blob.name)
+    failed = []
+    for batch, result in imap_concurrent(delete_batch, batches(), max_concurrency):
+        if isinstance(result, Exception):
+            raise result
+        total += len(batch) - len(result)
+        failed += result
+    if failed:
+        raise Exception(f'Could not delete {len(failed)} blobs: {", ".join(failed[:10])}' + (', ...' if len(failed) > 10 else ''))
     return total
+
+def blob_delete_all(connection_string:str, container:str, prefixes:List[str]=None, max_concurrency:int=MAX_CONCURRENCY):
+    filenames = (blob.name for blob in blob_list(connection_string, container, prefixes))
+    return blob_delete_many(connection_string, container, filenames, max_concurrency)
     
-def blob_reupload_old(container:str, connection_string:str, date:datetime.datetime, prefixes:List[str]=None):
+def blob_reupload_old(container:str, connection_string:str, date:datetime.datetime, prefixes:List[str]=None, max_concurrency:int=MAX_CONCURRENCY) -> Dict[str, Optional[Exception]]:
     '''
-    Delete and upload all files older than a given date
+    Reupload all files older than a given date, without deleting them (see `blob_refresh_many`)
+    Return `filename -> None` if it was reuploaded, or the exception otherwise
     '''
-    blob_service_client = BlobServiceClient.from_connection_string(connection_string)
-    container_client = blob_service_client.get_container_client(container)
-    total = 0
-    for blob in container_client.list_blobs():
-        if blob.last_modified > date:
-            if prefixes and not str_match_prefixes(blob.name, prefixes):
-                continue
-            total += 1
-            blob_reupload(container, connection_string, blob.name)
-    return total
+    filenames = (blob.name for blob in blob_list(connection_string, container, prefixes) if blob.last_modified < date)
+    return blob_refresh_many(connection_string, container, filenames, max_concurrency)
 
 def blob_download(connection_string:str, container:str, filename:str, filename_local: Optional[str]) -> Tuple[str, bytes]:
-    blob_client = BlobClient.from_connection_string(connection_string, container, filename)
-    content = blob_client.download_blob().readall()
+    '''
+    Whole content in memory; use `blob_download_file` for large files
+    '''
+    content = blob_client(connection_string, container, filename).download_blob().readall()
     assert content!=None
     if filename_local:
         with open(filename_local, 'wb') as f:
             f.write(content)
     return content
 
+def blob_download_file(connection_string:str, container:str, filename:str, f:Union[str, BinaryIO], max_concurrency:int=MAX_CONCURRENCY, **kwargs) -> int:
+    '''
+    Stream the blob into a local path or a writable binary file object, one chunk at a time
+    (up to `max_concurrency` chunks downloaded in parallel)
+    kwargs are passed to `download_blob` (eg: `etag` and `match_condition`)
+    Return the properties of the downloaded version (eg: its `etag`)
+    A missing blob raises `ResourceNotFoundError` before the local file is created
+    '''
+    downloader = blob_client(connection_string, container, filename).download_blob(max_concurrency=max_concurrency, **kwargs)
+    if isinstance(f, str):
+        with open(f, 'wb') as fp:
+            downloader.readinto(fp)
+    else:
+        downloader.readinto(f)
+    return downloader.properties
+
 def blob_get_file(container:str, connection_string:str, prefix:str=None) -> Tuple[str, bytes]:
     '''
     Get one file from the given prefix
+    Only the first page of the listing is requested
     '''
-    blob_service_client = BlobServiceClient.from_connection_string(connection_string)
-    container_client = blob_service_client.get_container_client(container)
-
-    for blob in container_client.list_blobs():
-        if prefix and blob.name[:len(prefix)] == prefix:
-            last_blob = container_client.get_blob_client(blob)
-            break
-    return last_blob.blob_name, last_blob.download_blob().readall()
+    blob = next(blob_list(connection_string, container, [prefix] if prefix else None), None)
+    if blob is None:
+        raise FileNotFoundError(f'No file with prefix {prefix}')
+    return blob.name, blob_client(connection_string, container, blob.name).download_blob().readall()
 
 def blob_get_last_file(container:str, connection_string:str, prefix:str=None) -> Tuple[str, bytes]:
-    blob_service_client = BlobServiceClient.from_connection_string(connection_string)
-    container_client = blob_service_client.get_container_client(container)
-    last_modified = datetime.datetime(1970, 1, 1, tzinfo=pytz.UTC)
-    last_blob = None
-    for blob in container_client.list_blobs():
+    last_modified = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+    last_name = None
+    for blob in blob_list(connection_string, container, [prefix] if prefix else None):
         if blob.last_modified > last_modified:
-            if prefix and blob.name[:len(prefix)] != prefix:
-                continue
             last_modified = blob.last_modified
-            last_blob = container_client.get_blob_client(blob)
-    return last_blob.blob_name, last_blob.download_blob().readall()
+            last_name = blob.name
+    if last_name is None:
+        raise FileNotFoundError(f'No file with prefix {prefix}')
+    return last_name, blob_client(connection_string, container, last_name).download_blob().readall()
 
-def blob_download_folder(connection_string:str, container:str, path_cloud:str, path_local:str) -> None:
+def blob_download_folder(connection_string:str, container:str, path_cloud:str, path_local:str, max_concurrency:int=MAX_CONCURRENCY) -> None:
     '''
     :param path_cloud Prefix that will determine if the file is downloaded
     :param folder to where the files will be downloaded; should not contain a trailling `/`; path must exists
     '''
-    blob_service_client = BlobServiceClient.from_connection_string(connection_string)
-    container_client = blob_service_client.get_container_client(container)
-    for blob in container_client.list_blobs():
-        if blob.name[:len(path_cloud)] == path_cloud:
-            blob_client = container_client.get_blob_client(blob)
-            with open(f'{path_local}/{blob_client.blob_name}', 'wb') as f:
-                f.write(blob_client.download_blob().readall())
+    def download(filename:str) -> None:
+        local = f'{path_local}/{filename}'
+        os.makedirs(os.path.dirname(local), exist_ok=True)
+        blob_download_file(connection_string, container, filename, local, max_concurrency=1)
+    filenames = [blob.name for blob in blob_list(connection_string, container, [path_cloud])]
+    for filename, result in map_concurrent(download, filenames, max_concurrency).items():
+        if isinstance(result, Exception):
+            raise result
 
 def blob_last_modified(container:str, connection_string:str):
     '''
     Return info about the last modified file in a given container
     '''
-    blob_service_client = BlobServiceClient.from_connection_string(connection_string)
-    container_client = blob_service_client.get_container_client(container)
-    last_modified = datetime.datetime(1970, 1, 1, tzinfo=pytz.UTC)
+    last_modified = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
     last_name = None
     total = 0
-    for blob in container_client.list_blobs():
+    for blob in blob_list(connection_string, container):
         total += 1
         if blob.last_modified > last_modified:
             last_modified = blob.last_modified
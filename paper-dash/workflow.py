@@ -1,8 +1,14 @@
-import pandas as pd
+import datetime
 import os
-from typing import Optional, List
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Callable, Dict, Optional, List, Union
 import logging
+from paperdash import StaticReport
 from paperdash import utils
+from paperdash import preprocess
 
 def workflow_generate_draft(
     batch,
@@ -15,110 +21,108 @@ def workflow_generate_draft(
 ) -> str:
     stage = 'draft' #Enum['draft', 'submited', 'final', 'sent']
     
-    #pré-cleanup
-    if os.path.exists('.report_temp'):
-        os.system('rm -r .report_temp')
-    if os.path.exists(report_name):
-        os.system(f'rm -r {report_name}')
-    if os.path.exists(f'{report_name}.zip'):
-        os.system(f'rm {report_name}.zip')
-    #end pré-cleanup
-
-    report_function(
+    report = report_function(
         None, 
         dependencies,
         generate_markdown=True,
-        zip_temp_folder=report_name,
         generate_pdf = False,
         template_config = template_config,
         instrutions=instrutions,
     )
-
-    assert os.path.exists(f'{report_name}.zip')
-    with open(f'{report_name}.zip', 'rb') as f:
-        content : bytes = f.read()
-
-    url = utils.blob_upload_and_generate_link(
-        os.getenv('BLOB_CONN_STRING'),
-        container = 'reports',
-        filename = f'{stage}/{batch}/{report_name}.zip',
-        content = content,
-        hours = hours,
-    )
+    # The workspace is removed even if the upload fails
+    with report:
+        # Zipped straight from the report workspace into a temporary file, and streamed from there
+        with tempfile.TemporaryFile() as f:
+            report.package(f)
+            f.seek(0)
+            url = utils.blob_upload_and_generate_link(
+                os.getenv('BLOB_CONN_STRING'),
+                container = 'reports',
+                filename = f'{stage}/{batch}/{report_name}.zip',
+                content = f,
+                hours = hours,
+            )
     assert url
-    
-    #pos-cleanup
-    os.system(f'rm {report_name}.zip')
-    #end pos-cleanup
-
     return url
 
 def workflow_generate_final(
     batch : str,
     report_name : str,
     hours : int = 168,
+    force : bool = False,
+    final_metadata : Optional[Dict[str, str]] = None,
 ):
-    out_path = f'../reports/{report_name}.pdf'
-    # Download submitted report
-    if utils.blob_exists(
-        os.getenv('BLOB_CONN_STRING'),
-        container = 'reports',
-        filename = f'submitted/{batch}/{report_name}.zip',
-    ):
-        print('>>>>>>>>>>>>>>>>>>>>>>>>>>', 1)
-        _ = utils.blob_download(
-            os.getenv('BLOB_CONN_STRING'),
-            container = 'reports',
-            filename = f'submitted/{batch}/{report_name}.zip',
-            filename_local = f'{report_name}.zip'
-        )
-    elif utils.blob_exists(
-        os.getenv('BLOB_CONN_STRING'),
-        container = 'reports',
-        filename = f'draft/{batch}/{report_name}.zip',
-    ):
-        print('>>>>>>>>>>>>>>>>>>>>>>>>>>', 2)
-        _ = utils.blob_download(
-            os.getenv('BLOB_CONN_STRING'),
-            container = 'reports',
-            filename = f'draft/{batch}/{report_name}.zip',
-            filename_local = f'{report_name}.zip'
-        )
+    '''
+    The final PDF stores in its metadata which zip it was compiled from, and that zip's ETag;
+    if the zip did not change since then (checked by the download itself, with If-None-Match),
+    the existing final is kept and only a new link is generated
+    The metadata is read with a HEAD of the final, unless it is given in `final_metadata`
+    (`{}` if there is no final yet), as `workflow_generate_batch` does from a single listing of the batch
+    With `force`, the report is always compiled
+    '''
+    # Everything is done in a folder of its own, so several reports can be generated at the same time
+    with tempfile.TemporaryDirectory(prefix='final_') as workdir:
+        return _generate_final(batch, report_name, hours, workdir, force, final_metadata)
+
+def _generate_final(
+    batch : str,
+    report_name : str,
+    hours : int,
+    workdir : str,
+    force : bool = False,
+    final_metadata : Optional[Dict[str, str]] = None,
+) -> str:
+    # azure is only imported when used, like in `utils`
+    from azure.core import MatchConditions
+    from azure.core.exceptions import ResourceModifiedError, ResourceNotFoundError, ResourceNotModifiedError
+    zip_path = f'{workdir}/{report_name}.zip'
+    report_path = f'{workdir}/{report_name}'
+    out_path = f'{workdir}/{report_name}.pdf'
+    final_name = f'final/{batch}/{report_name}.pdf'
+    if force:
+        recorded = {}
+    elif final_metadata is not None:
+        recorded = final_metadata
     else:
-        raise Exception(f'No report found for {report_name}')
+        final = utils.blob_properties(os.getenv('BLOB_CONN_STRING'), container = 'reports', filename = final_name)
+        recorded = final.metadata if final else {}
 
+    # Submitted report, or the draft if it was not submitted; one conditional request each:
+    # if the zip is still the one the final was compiled from, the service answers 304 and nothing is downloaded
+    for source_stage in ['submitted', 'draft']:
+        source_name = f'{source_stage}/{batch}/{report_name}.zip'
+        conditions = {}
+        # Only the stage is recorded: metadata values must be ASCII, and report names may not be
+        if recorded.get('source') == source_stage and recorded.get('source_etag'):
+            conditions = {'etag': '"' + recorded['source_etag'] + '"', 'match_condition': MatchConditions.IfModified}
+        try:
+            source = utils.blob_download_file(
+                os.getenv('BLOB_CONN_STRING'),
+                container = 'reports',
+                filename = source_name,
+                f = zip_path,
+                **conditions
+            )
+            break
+        except ResourceNotFoundError:
+            continue
+        except (ResourceNotModifiedError, ResourceModifiedError) as error:
+            # The storage SDK reports the 304 as ResourceModifiedError when the response has
+            # the ConditionNotMet error code; a real failed precondition (412) is raised
+            if isinstance(error, ResourceModifiedError) and error.status_code != 304:
+                raise
+            logging.info('%s did not change since the last final, skipping', source_name)
+            return utils.blob_download_link(os.getenv('BLOB_CONN_STRING'), 'reports', final_name, hours = hours)
+    else:
+        raise Exception(f'No report found for {report_name}')
+    logging.info('Generating %s from %s', final_name, source_name)
+    source_metadata = {'source': source_stage, 'source_etag': source.etag.strip('"')}
 
-    if os.path.exists(f'{report_name}/'):
-        os.system(f'rm -r {report_name}/')
-    os.system(f'mkdir {report_name} && cd {report_name} && unzip ../{report_name}.zip')
-    if os.path.exists(f'.report_temp/'):
-        os.system(f'rm -r .report_temp/')
-    os.system(f'mv {report_name} .report_temp')
+    with zipfile.ZipFile(zip_path) as z:
+        z.extractall(report_path)
 
-    # Remove instructions
-    with open('.report_temp/report.md', 'r') as f:
-        text : str = f.read()
-    
-    output_lines = []
-    is_in_comment : bool = False
-    for line in text.split('\n'):
-        if '==[MANUAL]==' in line:
-            is_in_comment = True
-            continue
-        elif '==[END OF MANUAL]==' in line:
-            is_in_comment = False
-            continue
-        elif is_in_comment:
-            continue
-        else:
-            output_lines.append(line)
-    text = '\n'.join(output_lines)
-    
-    with open('.report_temp/report.md', 'w') as f:
-        f.write(text)
-    
-    # Save 
-    report = shared.StaticReport.load('.report_temp')
+    # Save, removing the instructions before compiling
+    report = StaticReport.load(report_path, preprocessors=[preprocess.strip_manual])
     report.save(
         out_path, 
         header_footer_fist = True, 
@@ -126,27 +130,100 @@ def workflow_generate_final(
         generate_pdf = True,
     )
     assert os.path.exists(out_path)
-    with open(out_path, 'rb') as f:
-        content : bytes = f.read()
-    
-    # Upload
-    stage = 'final'
-    url = utils.blob_upload_and_generate_link(
-        os.getenv('BLOB_CONN_STRING'),
-        container = 'reports',
-        filename = f'{stage}/{batch}/{report_name}.pdf',
-        content = content,
-        hours = hours,
-        overwrite=True,
-    )
-    
-    #pos-cleanup
-    os.system(f'rm {out_path}')
-    #end pos-cleanup
-    
     
+    # Upload, streamed from the file
+    with open(out_path, 'rb') as f:
+        url = utils.blob_upload_and_generate_link(
+            os.getenv('BLOB_CONN_STRING'),
+            container = 'reports',
+            filename = final_name,
+            content = f,
+            hours = hours,
+            overwrite=True,
+            metadata = source_metadata,
+        )
     return url
 
+def _generate_with_retries(
+    stage : str,
+    batch : str,
+    report_name : str,
+    retries : int,
+    report_function : Optional[Callable],
+    dependencies : Optional[dict],
+    kwargs : dict,
+) -> str:
+    for attempt in range(retries + 1):
+        try:
+            if stage == 'draft':
+                return workflow_generate_draft(batch, report_name, dependencies, report_function, **kwargs)
+            return workflow_generate_final(batch, report_name, **kwargs)
+        except Exception:
+            if attempt == retries:
+                raise
+            logging.warning('Generating %s %s failed, retrying (%d/%d)', stage, report_name, attempt + 1, retries, exc_info=True)
+            time.sleep(2 ** attempt)
+
+def workflow_generate_batch(
+    batch : str,
+    report_names : List[str],
+    stage : str = 'final',
+    report_function : Optional[Callable] = None,
+    dependencies : Dict[str, dict] = {},
+    max_workers : Optional[int] = None,
+    retries : int = 2,
+    **kwargs
+) -> Dict[str, Union[str, BaseException]]:
+    '''
+    Generate the `draft` or `final` report of many customers of a batch in a process pool
+    Each report is downloaded, compiled and uploaded by one worker, in its own workspace, so the
+    transfers of some reports overlap with the compilation of others
+    Failed reports are retried up to `retries` times; the errors do not stop the batch
+    For finals, the metadata of the existing finals is read with one listing of the batch (see `workflow_generate_final`)
+    Return `report_name -> url`, or the exception of the last attempt
+    :param report_function, dependencies only for drafts; `dependencies` has one entry per report name
+    kwargs will be passed to `workflow_generate_draft`/`workflow_generate_final`
+    '''
+    if stage not in ('draft', 'final'):
+        raise ValueError(f'Invalid stage: {stage}')
+    if stage == 'draft' and report_function is None:
+        raise ValueError('report_function is required to generate drafts')
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+
+    report_kwargs = {report_name: kwargs for report_name in report_names}
+    if stage == 'final' and not kwargs.get('force'):
+        # One listing of the batch's finals instead of a HEAD per report; reports without a final get `{}`
+        prefix = f'final/{batch}/'
+        finals = {
+            blob.name[len(prefix):-len('.pdf')]: blob.metadata or {}
+            for blob in utils.blob_list(os.getenv('BLOB_CONN_STRING'), 'reports', [prefix], include=['metadata'])
+            if blob.name.endswith('.pdf')
+        }
+        report_kwargs = {
+            report_name: dict(kwargs, final_metadata=finals.get(report_name, {}))
+            for report_name in report_names
+        }
+
+    results = {}
+    # Workers must not reuse the connections of the clients inherited from this process
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=utils.blob_clear_clients) as executor:
+        futures = {
+            executor.submit(
+                _generate_with_retries, stage, batch, report_name, retries,
+                report_function, dependencies.get(report_name), report_kwargs[report_name],
+            ): report_name
+            # Repeated names are generated only once
+            for report_name in dict.fromkeys(report_names)
+        }
+        for future in as_completed(futures):
+            report_name = futures[future]
+            error = future.exception()
+            results[report_name] = error if error else future.result()
+            if error:
+                logging.error('Generating %s %s failed: %s', stage, report_name, error)
+    return {report_name: results[report_name] for report_name in report_names}
+
 
 
 
@@ -154,22 +231,23 @@ def workflow_generate_final(
 def example_report_template(
     out_path : str, 
     dependencies : dict, 
-    end_date : datetime.datetime = None, 
+    end_date : Optional[datetime.datetime] = None, 
     window_days : int = 30,
     verbosity : int=0, 
     template_config : dict = {},
     instrutions : bool = True,
     **kwargs
-) -> reporting.StaticReport:
+) -> StaticReport:
     '''
     kwargs will be passed to `save`
+    :param dependencies `connector` (any object with a `load()` method) and `customer` (dict with a `customerName`)
     '''
-    connector : Connector = dependencies['connector']
+    connector = dependencies['connector']
     connector.load()
     customer : dict = dependencies['customer']
-    dates = shared.datetime_ago(window_days = window_days, end_date = end_date)
+    dates = utils.datetime_ago(window_days = window_days, end_date = end_date)
 
-    report = reporting.StaticReport(
+    report = StaticReport(
         variables={
             'company': 'Skaylink CSC',
             'title': f"{customer['customerName']} - From {dates[0]} to {dates[1]}",
@@ -0,0 +1,52 @@
+'''
+Tables written in chunks (`paperdash.blocks.Table`)
+'''
+import pytest
+
+pd = pytest.importorskip('pandas')
+pytest.importorskip('tabulate')
+blocks = pytest.importorskip('paperdash.blocks')
+
+
+def cells(markdown:str) -> list:
+    # Each chunk pads its columns to its own width, so the tables are compared cell by cell,
+    # and only the alignment of the separator row (eg: `|:----|` and `|:--|` are the same)
+    rows = [[cell.strip() for cell in line.strip().strip('|').split('|')] for line in markdown.strip().split('\n')]
+    rows[1] = [(cell.startswith(':'), cell.endswith(':')) for cell in rows[1]]
+    return rows
+
+
+@pytest.fixture
+def df():
+    return pd.DataFrame({'id': range(23), 'name': [f'item {i}' for i in range(23)], 'value': [i / 4 for i in range(23)]})
+
+
+@pytest.mark.parametrize('index', [False, True])
+def test_chunks_are_stitched(df, index):
+    whole = blocks.Table(df, index=index, chunk_size=1000).to_markdown()
+    chunked = blocks.Table(df, index=index, chunk_size=5).to_markdown()
+    assert cells(chunked) == cells(whole)
+
+
+def test_latex_chunks_are_stitched(df):
+    whole = blocks.Table(df, latex=True, chunk_size=1000).to_markdown()
+    assert blocks.Table(df, latex=True, chunk_size=5).to_markdown() == whole
+    assert whole.count('\\begin{longtable}') == 1
+
+
+def test_more_rows_note(df):
+    markdown = blocks.Table(df, max_rows=10, chunk_size=3).to_markdown()
+    assert markdown.endswith('\n\n*13 more rows*\n\n')
+    assert len(cells(markdown.split('\n\n*')[0])) == 2 + 10
+    assert 'more rows' not in blocks.Table(df, max_rows=23).to_markdown()
+
+
+def test_columns(df):
+    markdown = blocks.Table(df, columns=['name', 'id'], chunk_size=5).to_markdown()
+    assert cells(markdown)[0] == ['name', 'id']
+
+
+def test_copy_is_not_affected_by_later_changes(df):
+    table = blocks.Table(df)
+    df.loc[0, 'name'] = 'changed'
+    assert 'changed' not in table.to_markdown()
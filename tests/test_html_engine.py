@@ -0,0 +1,31 @@
+'''
+In-process HTML output (`paperdash.html_engine`)
+'''
+import pytest
+
+html_engine = pytest.importorskip('paperdash.html_engine')
+
+
+@pytest.mark.parametrize('url', ['javascript:alert', 'JavaScript:alert', 'vbscript:x', 'data:text/html,x', '\x01javascript:alert'])
+def test_unsafe_links_are_plain_text(url):
+    assert html_engine.render_inline(f'[click]({url})') == 'click'
+
+
+def test_link():
+    assert html_engine.render_inline('[site](https://example.com/?a=1&b=2)') == \
+        '<a href="https://example.com/?a=1&amp;b=2">site</a>'
+
+
+def test_quotes_cannot_leave_the_attribute():
+    output = html_engine.render_inline('[x](https://example.com/"onmouseover="alert(1))')
+    assert '"onmouseover' not in output
+    assert '&quot;onmouseover=&quot;' in output
+
+
+def test_text_is_escaped():
+    assert html_engine.render_inline('<script>alert("x")</script>') == '&lt;script&gt;alert(&quot;x&quot;)&lt;/script&gt;'
+
+
+def test_lists():
+    output = html_engine.render_markdown('1. first\n2. second\n\n- a\n- b', '.')
+    assert output == '<ol><li>first</li><li>second</li></ol>\n<ul><li>a</li><li>b</li></ul>'
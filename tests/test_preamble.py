@@ -0,0 +1,65 @@
+'''
+Precompiled preamble (`paperdash.preamble`); the compile tests are skipped if pandoc or xelatex are not installed
+'''
+import shutil
+
+import pytest
+
+preamble = pytest.importorskip('paperdash.preamble')
+import paperdash
+from paperdash.cache import FileCache
+
+VARIABLES = {
+    'company': 'Company',
+    'title': 'Customer - From 2020-01-01 to 2020-01-31',
+    'author': 'Author',
+    'subject': 'Test',
+    'keywords': 'test',
+    'date': '2020-01-31 00:00:00',
+}
+
+requires_latex = pytest.mark.skipif(
+    not (shutil.which('pandoc') and shutil.which('xelatex')),
+    reason='pandoc and xelatex are not installed',
+)
+
+
+def test_split_static_headers():
+    files = {'static.tex': '\\usepackage{xcolor}', 'dynamic.tex': '\\title{$title$}'}
+    argv = ['pandoc', '--include-in-header', 'static.tex', '--include-in-header', 'dynamic.tex', '--include-in-header', 'static.tex']
+    new_argv, static = preamble.split_static_headers(argv, files)
+    assert new_argv == ['pandoc', '--include-in-header', 'dynamic.tex']
+    assert static == ['static.tex']
+
+
+def test_inject_static_headers():
+    prefix, body = preamble.inject_static_headers('\\documentclass[a4paper]{article}\n\\begin{document}', '\\usepackage{xcolor}')
+    assert prefix.startswith('\\documentclass[a4paper]{article}\n\\usepackage{xcolor}')
+    assert prefix.endswith(preamble.END_OF_DUMP + '\n')
+    assert body == '\n\\begin{document}'
+
+
+def render(tmp_path, format_cache:FileCache) -> bytes:
+    with paperdash.StaticReport(variables=VARIABLES, build_root=str(tmp_path / 'build'), format_cache=format_cache) as report:
+        report.add_text('Hello', style='title1')
+        report.add_text('World')
+        return report.save()
+
+
+@requires_latex
+def test_compile_with_format_cache(tmp_path):
+    format_cache = FileCache(str(tmp_path / 'formats'))
+    first = render(tmp_path, format_cache)
+    second = render(tmp_path, format_cache)
+    assert first.startswith(b'%PDF')
+    assert second.startswith(b'%PDF')
+
+
+@requires_latex
+def test_unloadable_format_falls_back(tmp_path, monkeypatch):
+    # eg: a format dumped by another TeX Live version
+    broken = tmp_path / 'broken.fmt'
+    broken.write_bytes(b'not a format file')
+    format_cache = FileCache(str(tmp_path / 'formats'))
+    monkeypatch.setattr(format_cache, 'get', lambda key: str(broken))
+    assert render(tmp_path, format_cache).startswith(b'%PDF')
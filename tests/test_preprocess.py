@@ -0,0 +1,46 @@
+'''
+Streaming filters of the markdown (`paperdash.preprocess`)
+'''
+import pytest
+
+preprocess = pytest.importorskip('paperdash.preprocess')
+
+TEXTS = [
+    'no manual\nat all\n',
+    'before\n==[MANUAL]==\ninstructions\n==[END OF MANUAL]==\nafter\n',
+    '==[MANUAL]==\nfirst\n==[END OF MANUAL]==\nkept\n\n==[MANUAL]==\nsecond\n==[END OF MANUAL]==\n',
+    'a\n<!-- ==[MANUAL]== -->\nb\n<!-- ==[END OF MANUAL]== -->\nc\n',
+    'a\n==[END OF MANUAL]==\nb\n==[MANUAL]==\n==[MANUAL]==\nc\n==[END OF MANUAL]==\nd\n',
+    'windows\r\n==[MANUAL]==\r\nx\r\n==[END OF MANUAL]==\r\nlines\r\n',
+]
+
+
+def strip_manual_whole_text(text:str) -> str:
+    # What `workflow_generate_final` used to do, with the whole file in memory
+    output_lines = []
+    is_in_comment = False
+    for line in text.split('\n'):
+        if '==[MANUAL]==' in line:
+            is_in_comment = True
+            continue
+        elif '==[END OF MANUAL]==' in line:
+            is_in_comment = False
+            continue
+        elif is_in_comment:
+            continue
+        else:
+            output_lines.append(line)
+    return '\n'.join(output_lines)
+
+
+@pytest.mark.parametrize('text', TEXTS)
+def test_strip_manual_as_before(text):
+    assert ''.join(preprocess.strip_manual(text.splitlines(keepends=True))) == strip_manual_whole_text(text)
+
+
+def test_process_file_in_place(tmp_path):
+    path = tmp_path / 'report.md'
+    path.write_bytes(TEXTS[-1].encode('utf-8'))
+    preprocess.process_file(str(path), str(path), [preprocess.strip_manual])
+    assert path.read_bytes() == b'windows\r\nlines\r\n'
+    assert [p.name for p in tmp_path.iterdir()] == ['report.md']
@@ -0,0 +1,57 @@
+'''
+Theme variables: escaping by file type and required variables (`paperdash.template`)
+'''
+import json
+import logging
+
+import pytest
+
+template = pytest.importorskip('paperdash.template')
+
+THEME = {
+    'files': {
+        'static.tex': '\\usepackage{xcolor}',
+        'title.tex': '\\title{$title$}',
+        'style.theme': '{"title": "$title$"}',
+        'notes.txt': '$title$ by $author$',
+    },
+    'images': {},
+    'required_variables': ['title', 'author'],
+}
+
+
+def test_latex_escape():
+    assert template.latex_escape('100% & $5_a #1 {x} ~ ^ \\') == \
+        '100\\% \\& \\$5\\_a \\#1 \\{x\\} \\textasciitilde{} \\textasciicircum{} \\textbackslash{}'
+
+
+def test_json_escape():
+    value = 'say "hi"\\\n'
+    assert json.loads('"' + template.json_escape(value) + '"') == value
+
+
+def test_render_escapes_by_file_type(tmp_path):
+    compiled = template.compile_theme(THEME, str(tmp_path / 'themes'))
+    compiled.materialize(str(tmp_path), {'title': 'R&D "50%"', 'author': 'A_B'})
+    assert (tmp_path / 'title.tex').read_text() == '\\title{R\\&D "50\\%"}'
+    assert json.loads((tmp_path / 'style.theme').read_text()) == {'title': 'R&D "50%"'}
+    assert (tmp_path / 'notes.txt').read_text() == 'R&D "50%" by A_B'
+    assert (tmp_path / 'static.tex').read_text() == '\\usepackage{xcolor}'
+
+
+def test_placeholders_without_value_are_kept():
+    assert template.Template('$title$ - $unknown$').render({'title': 'T'}) == 'T - $unknown$'
+
+
+def test_required_variables_strict(tmp_path):
+    compiled = template.compile_theme(THEME, str(tmp_path / 'themes'))
+    with pytest.raises(ValueError, match='author'):
+        compiled.materialize(str(tmp_path), {'title': 'T'}, strict=True)
+
+
+def test_required_variables_warning(tmp_path, caplog):
+    compiled = template.compile_theme(THEME, str(tmp_path / 'themes'))
+    with caplog.at_level(logging.WARNING):
+        compiled.materialize(str(tmp_path), {'title': 'T'})
+    assert 'author' in caplog.text
+    assert (tmp_path / 'notes.txt').read_text() == 'T by $author$'